@@ -0,0 +1,356 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlparse
+import aiohttp
+import lxml.html as lhtml
+from Crawlers import BaseCrawler, CrawlItem, CrawlJob, SeenLinks, HedgeDelay, TooManyRequestsError
+import Metrics
+
+
+class AsyncRequestHedger(HedgeDelay):
+    """
+    Races slow GETs against a duplicate - the `RequestHedger` of the `AsyncCrawler`.
+
+    The duplicate goes over a session of its own sharing the cookies of the original one. Whichever answers first
+    is used, the other one is cancelled.
+    """
+    def __init__(self, percentile=95, min_delay=0.05, window=200, min_samples=20):
+        super().__init__(percentile=percentile, min_delay=min_delay, window=window, min_samples=min_samples)
+        self.session = None
+        self.background = set()
+
+    def _get_session(self, session: aiohttp.ClientSession):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(cookie_jar=session.cookie_jar)
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    def _start(self, request):
+        task = asyncio.ensure_future(request)
+        # the loop only keeps weak references to its tasks
+        self.background.add(task)
+        task.add_done_callback(self._discard)
+        return task
+
+    def _discard(self, task):
+        self.background.discard(task)
+        if not task.cancelled():
+            # nobody waits for a loser failing before it got cancelled - don't report it as never retrieved
+            task.exception()
+
+    async def _timed(self, request):
+        started = time.monotonic()
+        result = await request
+        self._record(time.monotonic() - started)
+        return result
+
+    async def get(self, session: aiohttp.ClientSession, fetch, crawler_name):
+        """
+        `fetch(session)` is awaited with the given session and - if that is slow - with the hedging one.
+        """
+        delay = self.delay()
+        primary = self._start(self._timed(fetch(session)))
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        hedged = self._start(fetch(self._get_session(session)))
+        winner = None
+        pending = {primary, hedged}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+        for task in pending:
+            # don't keep a connection busy for an answer nobody reads
+            task.cancel()
+        if winner is None:
+            # both failed - report it like an unhedged request would
+            winner = primary
+        else:
+            Metrics.HEDGED_REQUESTS.inc(crawler=crawler_name, winner='primary' if winner is primary else 'hedge')
+        return winner.result()
+
+
+class AsyncCrawler(BaseCrawler):
+    """
+    Crawler running on a single asyncio event loop.
+
+    Offers the same selector/param/header/timeout API and emits the same signals as the threaded `Crawler`.
+    Instead of a fixed set of worker threads the number of requests this stage has in flight is bounded by
+    `worker_count`. Matches are handed to the `worker_callback` as tasks on the same loop - if the callback is
+    another `AsyncCrawler` the whole pipeline shares one loop and one connection pool. At most `max_pending`
+    matches are handled at a time, the others wait in the crawl that found them - like a full `WorkQueue` with
+    the BLOCK policy blocks. Proxies are not supported.
+    """
+    def __init__(self, worker_count=1, name='Crawler', worker_callback: callable = lambda _: "", max_pending=0):
+        super().__init__(name=name, worker_callback=worker_callback)
+        self.worker_count = worker_count
+        self.max_pending = max_pending
+        self.waiting = 0
+        self.http_session = None
+        self.hedger = None
+        self.loop = None
+        self.tasks = set()
+        self._semaphore = None
+        self._pending_semaphore = None
+        Metrics.QUEUE_DEPTH.set_function(lambda: self.waiting, crawler=name)
+        Metrics.QUEUE_CAPACITY.set(max_pending, crawler=name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+        if self.hedger:
+            await self.hedger.close()
+
+    def hedge(self, percentile=95):
+        """
+        Duplicate GETs slower than `percentile` of the recent ones - see `AsyncRequestHedger`.
+        Forms are never submitted twice.
+        """
+        self.hedger = AsyncRequestHedger(percentile=percentile)
+        return self
+
+    def _abort(self):
+        logging.debug('Received TERMINATE signal. Cancelling running crawls.')
+        for task in list(self.tasks):
+            task.cancel()
+
+    def _get_session(self):
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession()
+        # share the http_session if the callback is a crawler-instance
+        # this will probably decrease the number of refused connections
+        if isinstance(self.worker_callback, AsyncCrawler):
+            self.worker_callback.http_session = self.http_session
+        return self.http_session
+
+    def _get_semaphore(self):
+        # the semaphore has to be created on the loop it is used on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.worker_count)
+        return self._semaphore
+
+    def _get_pending_semaphore(self):
+        if self._pending_semaphore is None and self.max_pending:
+            self._pending_semaphore = asyncio.Semaphore(self.max_pending)
+        return self._pending_semaphore
+
+    @staticmethod
+    def _query_params(params):
+        # aiohttp neither expands lists nor accepts non-string values
+        query = []
+        for key, value in (params or {}).items():
+            values = value if isinstance(value, list) else [value]
+            query.extend((key, str(v)) for v in values)
+        return query
+
+    async def _request(self, method, url, hedge=False, **kwargs):
+        """
+        Sends the request once the rate limiter lets it through.
+        Returns status, headers, body, encoding and final url of the response. Raises `TooManyRequestsError`.
+        """
+        if self.rate_limiter:
+            await asyncio.sleep(self.rate_limiter.reserve(url))
+
+        async def fetch(session):
+            async with session.request(
+                method,
+                url,
+                timeout=aiohttp.ClientTimeout(total=self.connection_timeout),
+                **kwargs
+            ) as response:
+                body = await response.read()
+                return response.status, response.headers, body, response.get_encoding(), str(response.url)
+
+        async with self._get_semaphore():
+            started = time.monotonic()
+            if hedge and self.hedger:
+                result = await self.hedger.get(self._get_session(), fetch, self.name)
+            else:
+                result = await fetch(self._get_session())
+            Metrics.FETCH_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        if result[0] == 429:
+            raise TooManyRequestsError(result[1].get('Retry-After'))
+        return result
+
+    async def crawl(self, url, params=None, first_seen=None, seen_links=None):
+        """
+        Crawls the page and hands its matches to the callback. Returns the `CrawlJob` once all of them are
+        processed.
+        """
+        job = CrawlJob(url, params, seen_links, first_seen)
+        self.loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await self._main_crawler(job)
+        finally:
+            self.tasks.discard(task)
+            job.seal()
+        return job
+
+    def crawl_soon(self, url, params=None):
+        """
+        Schedules a crawl on the loop of this crawler - safe to call from any thread.
+        """
+        if self.loop is None or self.loop.is_closed():
+            logging.debug('%s is not running - not crawling %s', self.name, url)
+            return None
+        return asyncio.run_coroutine_threadsafe(self.crawl(url, params), self.loop)
+
+    async def crawl_sharded(self, url, shards):
+        """
+        Crawls all shards at once. Matches found by several shards are only handed on once.
+        """
+        seen_links = SeenLinks()
+        return await asyncio.gather(*[self.crawl(url, params, seen_links=seen_links) for params in shards])
+
+    async def fetch_document(self, url, params=None):
+        """
+        Fetches a single page right away and returns its root element with all links made absolute.
+        Raises `TooManyRequestsError`, `asyncio.TimeoutError` and the `aiohttp` exceptions.
+        """
+        try:
+            _, _, body, encoding, _ = await self._request(
+                'GET', url, hedge=True, params=self._query_params(params), headers=self.headers
+            )
+        except asyncio.TimeoutError:
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            raise
+        except TooManyRequestsError as tmr:
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, tmr.retry_after)
+            raise
+        if self.rate_limiter:
+            self.rate_limiter.on_success(url)
+        started = time.monotonic()
+        tree = lhtml.fromstring(body.decode(encoding, errors='replace'), base_url=url)
+        tree.make_links_absolute()
+        Metrics.PARSE_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        return tree
+
+    async def submit(self, form: lhtml.FormElement, extra_values=None):
+        """
+        Submits the form through this crawler's session - sharing its connection pool, headers, timeout and rate
+        limiter. Returns the root element of the parsed result page.
+        """
+        values = form.form_values()
+        if extra_values:
+            values.extend(extra_values.items() if hasattr(extra_values, 'items') else extra_values)
+        url = form.action or form.base_url
+        method = form.method.upper()
+        if method == 'POST':
+            payload = {'data': values}
+        else:
+            payload = {'params': [(key, str(value)) for key, value in values]}
+        started = time.monotonic()
+        try:
+            _, _, body, encoding, source_url = await self._request(method, url, headers=self.headers, **payload)
+        except asyncio.TimeoutError:
+            Metrics.TIMEOUTS.inc(crawler=self.name)
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            raise
+        except TooManyRequestsError as tmr:
+            Metrics.TOO_MANY_REQUESTS.inc(crawler=self.name)
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, tmr.retry_after)
+            raise
+        if self.rate_limiter:
+            self.rate_limiter.on_success(url)
+        document = self._parse_document(body.decode(encoding, errors='replace'), source_url)
+        Metrics.SUBMIT_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        return document
+
+    async def _main_crawler(self, job: CrawlJob):
+        url = job.url
+        params = self.params if job.params is None else job.params
+        logging.debug('%s started', self.name)
+        self._notify_crawl_started(asyncio.current_task())
+        items = []
+        try:
+            page_key = self._page_key(url, params)
+            status, response_headers, body, encoding, source_url = await self._request(
+                'GET',
+                url,
+                hedge=True,
+                params=self._query_params(params),
+                headers=self._request_headers(page_key),
+            )
+            if self.rate_limiter:
+                self.rate_limiter.on_success(url)
+            self._notify_progress()
+            if status == 304 or self._page_unchanged(page_key, response_headers, body):
+                logging.debug('%s did not change', urlparse(url).path)
+            else:
+                items = self._extract_items(body.decode(encoding, errors='replace'), url, source_url, job)
+                items = self._admit_items(job.unseen(self._changed_items(page_key, items)))
+            if len(items) > 0:
+                logging.info('Found %s links. Handing over to callback', len(items))
+        except asyncio.TimeoutError as e:
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            logging.info(
+                'Connection attempt to %s timed out after %s seconds.',
+                urlparse(url).path,
+                self.connection_timeout
+            )
+            job.fail(e)
+            self._notify_timeout(url)
+        except TooManyRequestsError as tmr:
+            logging.debug('Too many requests made')
+            job.fail(tmr)
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, tmr.retry_after)
+            self._notify_too_many_requests(url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning('Could not parse resulting page. %s', e)
+            job.fail(e)
+
+        if items:
+            # a crawl is done when all its matches have been processed
+            await asyncio.gather(*[self.parse(item) for item in items])
+        logging.debug('%s done', self.name)
+        self._notify_finish()
+
+    async def parse(self, item: CrawlItem):
+        item.queued_at = time.monotonic()
+        semaphore = self._get_pending_semaphore()
+        if semaphore:
+            self.waiting += 1
+            try:
+                await semaphore.acquire()
+            finally:
+                self.waiting -= 1
+        try:
+            Metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - item.queued_at, crawler=self.name)
+            self._notify_match_found(item.match, item.source_url, item.first_seen, item.attributes)
+            callback = self.worker_callback
+            if hasattr(callback, 'crawl'):
+                result = callback.crawl(item.href, first_seen=item.first_seen)
+            else:
+                result = callback(item.match)
+            if asyncio.iscoroutine(result):
+                await result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning('[%s]: could not process %s. %s', self.name, item.href, e)
+            item.job.fail(e)
+        finally:
+            if semaphore:
+                semaphore.release()
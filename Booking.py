@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+import aiohttp
+from lxml import etree
+import lxml.html as lhtml
+from requests.exceptions import ConnectTimeout, RequestException, ReadTimeout
+from Crawlers import Crawler, TooManyRequestsError, compile_selector
+from db import CustomerQueue
+import Metrics
+
+# form input -> customer field
+CUSTOMER_INPUTS = {
+    'Nachname': 'name',
+    'EMail': 'mail',
+    'telefonnummer_fuer_rueckfragen': 'phone',
+    'telefon': 'phone',
+}
+CONSENT_INPUTS = ('agbgelesen',)
+
+
+class FormLayout(object):
+    """
+    Which inputs of a booking form get which customer field - worked out once per kind of form.
+    """
+    __slots__ = ('customer_inputs', 'consent_inputs')
+
+    def __init__(self, input_names):
+        self.customer_inputs = tuple((name, field) for name, field in CUSTOMER_INPUTS.items() if name in input_names)
+        self.consent_inputs = tuple(name for name in CONSENT_INPUTS if name in input_names)
+
+    def fill(self, form: lhtml.FormElement, customer):
+        inputs = form.inputs
+        for name, field in self.customer_inputs:
+            inputs[name].value = customer[field]
+        for name in self.consent_inputs:
+            inputs[name].checked = True
+
+
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def form_layout(form: lhtml.FormElement) -> FormLayout:
+    input_names = frozenset(name for name in (element.get('name') for element in form.inputs) if name)
+    key = urlparse(form.action or '').path, input_names
+    layout = _layouts.get(key)
+    if layout is None:
+        with _layouts_lock:
+            layout = _layouts.setdefault(key, FormLayout(input_names))
+    return layout
+
+
+class BookingUncertain(Exception):
+    """
+    The form got submitted but no answer came back: the appointment may be booked. The claim of the customer is
+    on hold - don't release it.
+    """
+
+
+def _hold(customers: CustomerQueue, customer, error):
+    customers.hold(customer)
+    logging.error(
+        'No answer to the booking of appointment %s - holding the claim, reconcile it by hand. %s',
+        customer['appointment_id'], error
+    )
+
+
+def book(crawler: Crawler, form: lhtml.FormElement, customer, customers: CustomerQueue, first_seen=None):
+    """
+    Fills in the form for the customer and submits it through the crawler.
+    Returns `True` if the booking was confirmed - the caller still owns the claim of the customer otherwise.
+    Raises `BookingUncertain` if the submit failed after it may have reached the server.
+    Waits until the booking is saved.
+    """
+    form_layout(form).fill(form, customer)
+    try:
+        confirmation_page_tree = crawler.submit(form)
+    except ConnectTimeout:
+        # never got to the server
+        raise
+    except RequestException as e:
+        _hold(customers, customer, e)
+        raise BookingUncertain(customer['appointment_id']) from e
+    return _confirm(confirmation_page_tree, customer, customers, first_seen)
+
+
+async def book_async(crawler, form: lhtml.FormElement, customer, customers: CustomerQueue, first_seen=None):
+    """
+    `book` through an `AsyncCrawler` - the booking is saved off the event loop.
+    """
+    form_layout(form).fill(form, customer)
+    loop = asyncio.get_running_loop()
+    try:
+        confirmation_page_tree = await crawler.submit(form)
+    except aiohttp.ClientConnectorError:
+        raise
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        await loop.run_in_executor(None, _hold, customers, customer, e)
+        raise BookingUncertain(customer['appointment_id']) from e
+    return await loop.run_in_executor(
+        None, _confirm, confirmation_page_tree, customer, customers, first_seen
+    )
+
+
+def _confirm(confirmation_page_tree, customer, customers: CustomerQueue, first_seen=None):
+    cancel_tokens = compile_selector('.number-red-big')(confirmation_page_tree)
+    if len(cancel_tokens) == 0:
+        return False
+    # the appointment exists from here on - whatever the page looks like, the customer must not be booked again
+    result_file = 'confirm_' + str(customer['appointment_id']) + '.html'
+    # save result for analysis
+    with open(result_file, 'wb') as rf:
+        rf.write(etree.tostring(confirmation_page_tree))
+    confirmations = confirmation_page_tree.xpath('//*[@id="hhibody"]/div[3]')
+    if not confirmations:
+        logging.warning('No confirmation found for appointment %s', customer['appointment_id'])
+    cancel_token = cancel_tokens[0].text
+    confirmation = etree.tostring(confirmations[0]) if confirmations else b''
+    try:
+        customers.commit(customer, cancel_token, confirmation).result()
+    except sqlite3.Error as e:
+        logging.warning('Could not save the booking of appointment %s - retrying. %s', customer['appointment_id'], e)
+        try:
+            customers.commit(customer, cancel_token, confirmation).result()
+        except sqlite3.Error as e:
+            # still booked: the caller keeps the claim, the token is only left in the log
+            logging.error(
+                'Could not save cancel token %s of appointment %s. %s', cancel_token, customer['appointment_id'], e
+            )
+            return True
+    if first_seen:
+        Metrics.SLOT_TO_BOOKING_SECONDS.observe(time.time() - first_seen)
+    logging.debug('got appointment for %s', customer['name'])
+    return True
+
+
+class FormBooking(object):
+    """
+    Books the forms found by the form crawler. Use it as `worker_callback` of the form crawler: the booking is part
+    of the crawl, so the crawl job only finishes once the form got submitted. `on_booked` is called with the link
+    of every slot booked.
+    """
+    def __init__(self, customers: CustomerQueue, on_booked: callable = None):
+        self.customers = customers
+        self.on_booked = on_booked
+
+    def handle_match(self, crawler: Crawler, form, source_url, first_seen=None):
+        customer = self.customers.claim()
+        if customer is None:
+            logging.debug('No customer waiting for %s', source_url)
+            return
+        try:
+            booked = book(crawler, form, customer, self.customers, first_seen)
+        except BookingUncertain:
+            # the claim is on hold - the crawl job fails and the slot is tried again
+            raise
+        except BaseException:
+            self.customers.release(customer)
+            raise
+        if not booked:
+            self.customers.release(customer)
+        elif self.on_booked:
+            self.on_booked(source_url)
+
+
+class BookingFastPath(object):
+    """
+    Books a slot as soon as its link is found.
+
+    Use it in place of the form crawler as `worker_callback` of the stage finding the slot links: the worker
+    fetches the form page, fills in a customer claimed in advance and submits - in one go, without queueing
+    another crawl. Customers whose booking failed stay claimed for the next slot - unless the submit went
+    unanswered, see `BookingUncertain`. `on_booked` is called with the link of every slot booked.
+    """
+    def __init__(self, form_crawler: Crawler, customers: CustomerQueue, prefetch=2, on_booked: callable = None):
+        self.form_crawler = form_crawler
+        self.on_booked = on_booked
+        self.customers = customers
+        self.prefetch = prefetch
+        self.claimed = deque()
+        self.lock = threading.Lock()
+
+    def _take_customer(self):
+        while True:
+            with self.lock:
+                customer = self.claimed.popleft() if self.claimed else None
+            if customer is None:
+                return self.customers.claim()
+            if time.time() - customer['claimed_at'] < self.customers.claim_timeout / 2 \
+                    or self.customers.renew(customer):
+                return customer
+            # the claim ran out and somebody else may have the customer by now
+
+    def _return_customer(self, customer):
+        with self.lock:
+            self.claimed.appendleft(customer)
+
+    def prefetch_customers(self):
+        with self.lock:
+            missing = self.prefetch - len(self.claimed)
+        for _ in range(missing):
+            customer = self.customers.claim()
+            if customer is None:
+                break
+            self._return_customer(customer)
+
+    def renew_claims(self):
+        """
+        Keeps the customers claimed in advance from being released as abandoned - call it at least every
+        `claim_timeout / 2` seconds. Customers whose claim got lost already are replaced.
+        """
+        with self.lock:
+            customers = list(self.claimed)
+        lost = [customer for customer in customers if not self.customers.renew(customer)]
+        with self.lock:
+            for customer in lost:
+                if customer in self.claimed:
+                    self.claimed.remove(customer)
+        self.prefetch_customers()
+
+    def release(self):
+        with self.lock:
+            customers = list(self.claimed)
+            self.claimed.clear()
+        for customer in customers:
+            self.customers.release(customer)
+
+    def crawl(self, url, params=None, group=None, first_seen=None):
+        customer = self._take_customer()
+        if customer is None:
+            logging.debug('No customer waiting for %s', url)
+            return
+        booked = on_hold = False
+        try:
+            forms = self._fetch_forms(url, params)
+            if forms:
+                try:
+                    booked = book(self.form_crawler, forms[0], customer, self.customers, first_seen)
+                except BookingUncertain:
+                    on_hold = True
+                except TooManyRequestsError:
+                    self.form_crawler._notify_too_many_requests(url)
+                except RequestException as e:
+                    logging.warning('Could not book %s. %s', url, e)
+        finally:
+            if not booked and not on_hold:
+                self._return_customer(customer)
+        if booked:
+            if self.on_booked:
+                self.on_booked(url)
+            self.prefetch_customers()
+
+    def _fetch_forms(self, url, params):
+        try:
+            tree = self.form_crawler.fetch_document(url, params)
+        except ReadTimeout:
+            self.form_crawler._notify_timeout(url)
+        except TooManyRequestsError:
+            self.form_crawler._notify_too_many_requests(url)
+        except RequestException as e:
+            logging.warning('Could not fetch %s. %s', url, e)
+        else:
+            return self.form_crawler.selector(tree)
+        return []
+
+
+class AsyncBookingFastPath(BookingFastPath):
+    """
+    `BookingFastPath` for a pipeline of `AsyncCrawler`s: `form_crawler` is an `AsyncCrawler` as well.
+    The customer queue is only used off the event loop.
+    """
+    async def crawl(self, url, params=None, first_seen=None):
+        loop = asyncio.get_running_loop()
+        customer = await loop.run_in_executor(None, self._take_customer)
+        if customer is None:
+            logging.debug('No customer waiting for %s', url)
+            return
+        booked = on_hold = False
+        try:
+            forms = await self._fetch_forms(url, params)
+            if forms:
+                try:
+                    booked = await book_async(self.form_crawler, forms[0], customer, self.customers, first_seen)
+                except BookingUncertain:
+                    on_hold = True
+                except TooManyRequestsError:
+                    self.form_crawler._notify_too_many_requests(url)
+                except aiohttp.ClientError as e:
+                    logging.warning('Could not book %s. %s', url, e)
+        finally:
+            if not booked and not on_hold:
+                self._return_customer(customer)
+        if booked:
+            if self.on_booked:
+                await loop.run_in_executor(None, self.on_booked, url)
+            await loop.run_in_executor(None, self.prefetch_customers)
+
+    async def _fetch_forms(self, url, params):
+        try:
+            tree = await self.form_crawler.fetch_document(url, params)
+        except asyncio.TimeoutError:
+            self.form_crawler._notify_timeout(url)
+        except TooManyRequestsError:
+            self.form_crawler._notify_too_many_requests(url)
+        except aiohttp.ClientError as e:
+            logging.warning('Could not fetch %s. %s', url, e)
+        else:
+            return self.form_crawler.selector(tree)
+        return []
@@ -1,14 +1,110 @@
+import hashlib
+import heapq
+import itertools
 import logging
-from queue import Queue, Empty
-from urllib.parse import urlparse
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from queue import Queue, Empty, Full
+from urllib.parse import urlparse, urljoin, urlunparse, parse_qsl, urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import lxml.html as lhtml
+from lxml.cssselect import CSSSelector
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from requests.exceptions import ReadTimeout
 from pydispatch import dispatcher
+from RateLimiter import default_rate_limiter
+from EventBus import EventBus, default_bus
+import Metrics
 
 
-class Crawler(object):
+_parsers = threading.local()
+# the crawler doing requests on the current thread - for the connection metrics
+_request_context = threading.local()
+
+
+def throttled_seconds(thread: threading.Thread, now=None):
+    """
+    How long the thread has waited for the rate limiter altogether - see `throttle`.
+    """
+    since = getattr(thread, 'throttled_since', None)
+    waiting = (time.monotonic() if now is None else now) - since if since is not None else 0.0
+    return getattr(thread, 'throttled_seconds', 0.0) + waiting
+
+
+def throttle(rate_limiter, url):
+    """
+    Waits until the rate limiter lets a request to `url` through. The time waited is kept on the thread: a worker
+    waiting for its turn is not stuck.
+    """
+    thread = threading.current_thread()
+    thread.throttled_since = time.monotonic()
+    try:
+        rate_limiter.acquire(url)
+    finally:
+        # add up first - counting the wait twice for a moment is safe, missing it is not
+        thread.throttled_seconds = throttled_seconds(thread)
+        thread.throttled_since = None
+
+
+@lru_cache(maxsize=64)
+def compile_selector(css_selector) -> CSSSelector:
+    # translating css to xpath is costly - do it once per selector
+    return CSSSelector(css_selector, translator='html')
+
+
+def _link_parser():
+    # lxml parsers must not be shared between threads
+    if not hasattr(_parsers, 'links'):
+        _parsers.links = lhtml.HTMLParser(remove_comments=True, remove_pis=True, collect_ids=False)
+    return _parsers.links
+
+
+class _TimedConnectionMixin(object):
+    def connect(self):
+        started = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            Metrics.CONNECT_SECONDS.observe(
+                time.monotonic() - started,
+                crawler=getattr(_request_context, 'crawler', '')
+            )
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Transport adapter recording how long new connections take to set up.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+class BaseCrawler(object):
     SIGNAL_OUT_CRAWL_STARTED = 'crawler.crawl_started'
     SIGNAL_OUT_FINISHED = 'crawler.finished'
     SIGNAL_OUT_MATCH_FOUND = 'crawler.match_found'
@@ -18,38 +114,30 @@ class Crawler(object):
     SIGNAL_OUT_TIMEOUT = 'crawler.connection_timeout'
     SIGNAL_OUT_TOO_MANY_REQUESTS = 'crawler.too_many_requests'
 
-    def __init__(self, worker_count=1, name='Crawler', worker_callback: callable = lambda _: ""):
+    def __init__(self, name='Crawler', worker_callback: callable = lambda _: ""):
         dispatcher.connect(self._abort, signal=self.SIGNAL_IN_TERMINATE)
 
         self.params = {}
         self.headers = {'User-Agent': 'PyPoeci'}
         self.css_selector = 'a'  # find all links - most probably too general
+        self.selector = compile_selector(self.css_selector)
+        self.link_attribute = None
+        self.link_extra_attributes = ()
+        self.link_keep_text = False
         self.connection_timeout = 30
-        self.workers = []
-
-        self.lock = threading.RLock()
-        self.queue = Queue()
-        self.http_session = requests.Session()
-        # share the http_session if the callback is a crawler-instance
-        # this will probably decrease the number of refused connections
-        if isinstance(worker_callback, Crawler):
-            worker_callback.http_session = self.http_session
+        self.match_filter = None
+        self.frontier = None
+        self.change_detection = False
+        self.recheck_after = None
+        self._page_states = {}
+        self._page_states_lock = threading.Lock()
+        self.rate_limiter = default_rate_limiter
+        self.proxies = None
+        self.event_bus = default_bus
 
         self.worker_callback = worker_callback
-        self.worker_count = worker_count
         self.name = name
 
-        self.start_workers(worker_count=worker_count, worker_args=[worker_callback])
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop_workers()
-
-    def __del__(self):
-        self.abort_workers()
-
     def set_timeout(self, timeout):
         self.connection_timeout = timeout
         return self
@@ -66,148 +154,1067 @@ class Crawler(object):
 
     def set_selector(self, css_selector):
         self.css_selector = css_selector
+        self.selector = compile_selector(css_selector)
+        return self
+
+    def extract_links(self, attribute='href', keep_attributes=(), keep_text=False):
+        """
+        Only hand the (absolute) value of the given attribute of every match to the workers.
+
+        Skips making every link of the document absolute and parses with a lighter parser.
+        The matched elements are not kept alive - only the attributes listed in `keep_attributes` are copied, and
+        the text of the match as attribute `text` with `keep_text`.
+        Use this for stages that merely follow links.
+        """
+        self.link_attribute = attribute
+        self.link_extra_attributes = tuple(keep_attributes)
+        self.link_keep_text = keep_text
+        return self
+
+    def filter_matches(self, predicate: callable):
+        """
+        Only hand on the matches for which `predicate(item)` is true.
+        """
+        self.match_filter = predicate
+        return self
+
+    def set_frontier(self, frontier):
+        """
+        Skip matches the given `UrlFrontier` has already seen within its TTL.
+        Frontiers may be shared between crawlers.
+        """
+        self.frontier = frontier
+        return self
+
+    def detect_changes(self, recheck_after=None):
+        """
+        Poll conditionally and only hand on what changed since the last crawl of the same request.
+
+        ETag/Last-Modified of every request are sent back with the next one; a 304 or a body identical to the
+        previous one is not parsed at all. Of a changed page only matches that were not there before are queued.
+        After `recheck_after` seconds all matches of a page are queued again.
+        """
+        self.change_detection = True
+        self.recheck_after = recheck_after
+        return self
+
+    def forget(self, href):
+        """
+        Hand on `href` again the next time it is found - e.g. after its crawl failed.
+        Drops it from the frontier and from the matches remembered for change detection.
+        """
+        if self.frontier is not None:
+            self.frontier.forget(href)
+        with self._page_states_lock:
+            for state in self._page_states.values():
+                if href in state.links:
+                    state.links = state.links - {href}
+                    # an unchanged page would not be parsed at all
+                    state.etag = state.last_modified = state.digest = None
+
+    def set_proxies(self, proxies):
+        """
+        Proxies to send this crawler's requests through, e.g. `{'https': 'socks5h://127.0.0.1:9050'}`.
+        Applies per request, so crawlers sharing a session can still use different proxies.
+        """
+        self.proxies = proxies
+        return self
+
+    def set_event_bus(self, event_bus: EventBus):
+        """
+        Publish this crawler's SIGNAL_OUT_* events on another bus than the shared one.
+        """
+        self.event_bus = event_bus
+        return self
+
+    def set_rate_limiter(self, rate_limiter):
+        """
+        Use another `AdaptiveRateLimiter` than the one shared by all crawlers - or none at all.
+        """
+        self.rate_limiter = rate_limiter
+        return self
+
+    def _abort(self):
+        pass
+
+    def crawl(self, url, params=None, first_seen=None):
+        raise NotImplementedError()
+
+    def shards(self, **shard_sizes):
+        """
+        Splits the list parameters named in `shard_sizes` into chunks of the given size.
+
+        Returns one complete parameter set per combination of chunks, e.g. `shards(dienstleister=10)` for 47
+        locations gives five parameter sets of at most ten locations each. Pass them to `crawl(url, params)`.
+        """
+        chunked = []
+        for key, size in shard_sizes.items():
+            key = key if key in self.params else key + '[]'
+            values = self.params.get(key)
+            if not isinstance(values, list) or not size:
+                continue
+            chunked.append([(key, values[i:i + size]) for i in range(0, len(values), size)])
+        shards = []
+        for combination in itertools.product(*chunked):
+            params = dict(self.params)
+            params.update(combination)
+            shards.append(params)
+        return shards
+
+    def _page_key(self, url, params):
+        return url, repr(sorted(params.items()))
+
+    def _request_headers(self, page_key):
+        if not self.change_detection:
+            return self.headers
+        state = self._page_states.get(page_key)
+        if state is None or state.expired(self.recheck_after):
+            return self.headers
+        headers = dict(self.headers)
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+        return headers
+
+    def _page_unchanged(self, page_key, response_headers, body: bytes):
+        """
+        Remembers the validators and the body hash of the response and tells if the page is the same as before.
+        """
+        if not self.change_detection:
+            return False
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        with self._page_states_lock:
+            state = self._page_states.get(page_key)
+            if state is None or state.expired(self.recheck_after):
+                state = self._page_states[page_key] = PageState()
+            unchanged = state.digest == digest
+            state.etag = response_headers.get('ETag')
+            state.last_modified = response_headers.get('Last-Modified')
+            state.digest = digest
+        return unchanged
+
+    def _changed_items(self, page_key, items):
+        if not self.change_detection:
+            return items
+        with self._page_states_lock:
+            state = self._page_states[page_key]
+            previous_links = state.links
+            state.links = frozenset(item.href for item in items)
+        changed = [item for item in items if item.href not in previous_links]
+        logging.debug('%s of %s matches changed', len(changed), len(items))
+        return changed
+
+    def _extract_items(self, html, base_url, source_url, job=None):
+        started = time.monotonic()
+        try:
+            return self._extract(html, base_url, source_url, job)
+        finally:
+            Metrics.PARSE_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+
+    def _extract(self, html, base_url, source_url, job):
+        if self.link_attribute:
+            tree = lhtml.document_fromstring(html, parser=_link_parser())
+            items = []
+            for match in self.selector(tree):
+                link = match.get(self.link_attribute)
+                if not link:
+                    continue
+                attributes = {name: match.get(name) for name in self.link_extra_attributes}
+                if self.link_keep_text:
+                    attributes['text'] = match.text_content().strip()
+                items.append(CrawlItem(source_url, urljoin(base_url, link.strip()), attributes or None, job=job))
+            return items
+        tree = lhtml.fromstring(html)
+        tree.make_links_absolute(base_url=base_url)
+        return [CrawlItem(source_url, match.get('href'), element=match, job=job) for match in self.selector(tree)]
+
+    @staticmethod
+    def _parse_document(html, base_url):
+        return lhtml.document_fromstring(html, parser=_link_parser(), base_url=base_url)
+
+    def _admit_items(self, items):
+        if self.match_filter:
+            items = [item for item in items if self.match_filter(item)]
+        if self.frontier is None:
+            return items
+        admitted = [item for item in items if not item.href or self.frontier.admit(item.href)]
+        if len(admitted) < len(items):
+            logging.debug('Skipping %s recently seen links', len(items) - len(admitted))
+        return admitted
+
+    def _notify_crawl_started(self, crawl_thread):
+        self.event_bus.publish(self.SIGNAL_OUT_CRAWL_STARTED, sender=crawl_thread)
+
+    def _notify_progress(self):
+        self.event_bus.publish(self.SIGNAL_OUT_PROGRESS, sender=self)
+
+    def _notify_finish(self):
+        self.event_bus.publish(self.SIGNAL_OUT_FINISHED, sender=self)
+
+    def _notify_too_many_requests(self, requested_url):
+        Metrics.TOO_MANY_REQUESTS.inc(crawler=self.name)
+        self.event_bus.publish(
+            self.SIGNAL_OUT_TOO_MANY_REQUESTS,
+            sender=self,
+            url=requested_url,
+        )
+
+    def _notify_timeout(self, requested_url):
+        Metrics.TIMEOUTS.inc(crawler=self.name)
+        self.event_bus.publish(
+            self.SIGNAL_OUT_TIMEOUT,
+            sender=self,
+            url=requested_url,
+        )
+
+    def _notify_match_found(self, match, source_url, first_seen=None, attributes=None):
+        self.event_bus.publish(
+            self.SIGNAL_OUT_MATCH_FOUND,
+            sender=self,
+            match=match,
+            source_url=source_url,
+            first_seen=first_seen,
+            attributes=attributes,
+        )
+
+
+class PageState(object):
+    """
+    What a crawler saw the last time it requested a page.
+    """
+    __slots__ = ('etag', 'last_modified', 'digest', 'links', 'created')
+
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.links = frozenset()
+        self.created = time.monotonic()
+
+    def expired(self, max_age):
+        return max_age is not None and time.monotonic() - self.created > max_age
+
+
+class UrlFrontier(object):
+    """
+    Remembers which urls have been handed on recently.
+
+    Urls are normalized before comparison. An url is admitted again once its TTL has expired.
+    Memory is bounded by evicting the least recently seen urls once `max_size` entries are stored.
+    """
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    @staticmethod
+    def normalize(url):
+        parts = urlparse(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        if (scheme, parts.port) in (('http', 80), ('https', 443)):
+            netloc = netloc.rsplit(':', 1)[0]
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunparse((scheme, netloc, parts.path or '/', parts.params, query, ''))
+
+    def admit(self, url):
+        """
+        Returns `True` if the url was not seen within the TTL and marks it as seen.
+        """
+        key = self.normalize(url)
+        now = time.monotonic()
+        with self._lock:
+            seen_at = self._seen.get(key)
+            if seen_at is not None and now - seen_at < self.ttl:
+                return False
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+        return True
+
+    def forget(self, url):
+        with self._lock:
+            self._seen.pop(self.normalize(url), None)
+
+
+class CrawlItem(object):
+    """
+    A single match queued for the workers.
+
+    Link-following stages only store the extracted link (and the attributes they asked for) so a queued job does
+    not keep the whole parsed document alive. Only stages that work on the element itself keep a reference to it.
+    """
+    __slots__ = ('source_url', 'href', 'attributes', 'element', 'job', 'first_seen', 'queued_at')
+
+    def __init__(self, source_url, href, attributes=None, element=None, job=None):
+        self.source_url = source_url
+        self.href = href
+        self.attributes = attributes
+        self.element = element
+        self.job = job
+        # when the first stage of the pipeline found what led to this item
+        self.first_seen = job.first_seen if job and job.first_seen else time.time()
+        self.queued_at = None
+
+    @property
+    def match(self):
+        return self.element if self.element is not None else self.href
+
+
+class CrawlJob(object):
+    """
+    Context of a single crawl.
+
+    Keeps track of the matches the crawl has queued. The job is done as soon as the crawl itself has finished and
+    every one of its matches has been processed by a worker. `error` holds what made the crawl or one of its
+    matches fail - it stays `None` if everything went through.
+    """
+    def __init__(self, url, params=None, seen_links=None, first_seen=None):
+        self.url = url
+        self.params = params
+        self.first_seen = first_seen
+        self.seen_links = seen_links
+        self.thread = None
+        self.error = None
+        self.future = Future()
+        self._pending = 0
+        self._sealed = False
+        self._lock = threading.Lock()
+
+    def add_task(self):
+        with self._lock:
+            self._pending += 1
+
+    def task_done(self):
+        with self._lock:
+            self._pending -= 1
+            self._finish_if_done()
+
+    def seal(self):
+        # no more tasks will be added
+        with self._lock:
+            self._sealed = True
+            self._finish_if_done()
+
+    def _finish_if_done(self):
+        if self._sealed and self._pending <= 0 and not self.future.done():
+            self.future.set_result(self.url)
+
+    def fail(self, error):
+        # the first failure is the one to report
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def done(self):
+        return self.future.done()
+
+    def join(self, timeout=None):
+        """
+        Waits for the job. Returns `False` if it is still running after `timeout` seconds.
+        """
+        try:
+            self.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            pass
+        return self.future.done()
+
+    def unseen(self, items):
+        """
+        Drops items already queued by another job of the same `CrawlGroup`.
+        """
+        if self.seen_links is None:
+            return items
+        with self.seen_links.lock:
+            unseen = [item for item in items if item.href not in self.seen_links]
+            self.seen_links.update(item.href for item in unseen)
+        return unseen
+
+
+class SeenLinks(set):
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+
+class CrawlGroup(object):
+    """
+    Crawls of the shards of one request. Matches found by several shards are only queued once.
+    """
+    def __init__(self):
+        self.jobs = []
+        self.seen_links = SeenLinks()
+
+    def done(self):
+        return all(job.done() for job in self.jobs)
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in self.jobs:
+            job.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+
+class WorkQueue(Queue):
+    """
+    Work queue of a crawler, holding at most `maxsize` matches (0: no limit).
+
+    `policy` decides what happens to a match put into a full queue:
+    `BLOCK` makes the producer wait for room, `DROP_OLDEST` drops the match queued longest ago in favour of the
+    new one and `COALESCE` drops matches whose link is queued already - full or not - and blocks otherwise.
+    Dropped matches count as done for their crawl. The workers' stop signal is never held back.
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+    def __init__(self, maxsize=0, policy=BLOCK, name=None):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown queue policy: {}'.format(policy))
+        self.policy = policy
+        self.name = name
+        self.stop_signals = 0
+        self.queued_links = {}
+        super().__init__(maxsize)
+
+    def items(self):
+        """
+        Number of queued matches - without stop signals.
+        """
+        with self.mutex:
+            return self._qsize() - self.stop_signals
+
+    def put(self, item, block=True, timeout=None):
+        dropped = None
+        with self.not_full:
+            if item is None:
+                pass
+            elif self.policy == self.COALESCE and item.href and item.href in self.queued_links:
+                dropped = item
+            elif self.maxsize > 0 and self.policy == self.DROP_OLDEST:
+                if self._qsize() - self.stop_signals >= self.maxsize:
+                    dropped = self._take(self._pop_oldest())
+                    self.unfinished_tasks -= 1
+            elif self.maxsize > 0:
+                self._wait_for_room(block, timeout)
+            coalesced = dropped is not None and dropped is item
+            if not coalesced:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+        if dropped is not None:
+            if coalesced:
+                Metrics.QUEUE_COALESCED.inc(crawler=self.name)
+            else:
+                Metrics.QUEUE_DROPPED.inc(crawler=self.name)
+            dropped.job.task_done()
+
+    def _wait_for_room(self, block, timeout):
+        # as in Queue.put - but only matches take up room
+        if not block:
+            if self._qsize() - self.stop_signals >= self.maxsize:
+                raise Full
+        elif timeout is None:
+            while self._qsize() - self.stop_signals >= self.maxsize:
+                self.not_full.wait()
+        elif timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        else:
+            deadline = time.monotonic() + timeout
+            while self._qsize() - self.stop_signals >= self.maxsize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    raise Full
+                self.not_full.wait(remaining)
+
+    def _put(self, item):
+        if item is None:
+            self.stop_signals += 1
+        elif item.href:
+            self.queued_links[item.href] = self.queued_links.get(item.href, 0) + 1
+        self._push(item)
+
+    def _get(self):
+        return self._take(self._pop())
+
+    def _take(self, item):
+        if item is None:
+            self.stop_signals -= 1
+        elif item.href:
+            count = self.queued_links.pop(item.href) - 1
+            if count:
+                self.queued_links[item.href] = count
+        return item
+
+    # storage - override these to change the order
+
+    def _push(self, item):
+        self.queue.append(item)
+
+    def _pop(self):
+        return self.queue.popleft()
+
+    def _pop_oldest(self):
+        for i, item in enumerate(self.queue):
+            if item is not None:
+                del self.queue[i]
+                return item
+
+
+class PriorityWorkQueue(WorkQueue):
+    """
+    Work queue handing out the item with the lowest `key(item)` first.
+
+    Items with equal keys keep their order. Items the key can't rank (it returns `None` or raises) come after
+    all ranked ones, the workers' stop signal after everything else.
+    """
+    def __init__(self, key: callable, maxsize=0, policy=WorkQueue.BLOCK, name=None):
+        self.key = key
+        self.counter = itertools.count()
+        super().__init__(maxsize, policy, name)
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _push(self, item):
+        heapq.heappush(self.queue, (self._rank(item), next(self.counter), item))
+
+    def _pop(self):
+        return heapq.heappop(self.queue)[2]
+
+    def _pop_oldest(self):
+        oldest = min(
+            (i for i, entry in enumerate(self.queue) if entry[2] is not None),
+            key=lambda i: self.queue[i][1]
+        )
+        entry = self.queue[oldest]
+        self.queue[oldest] = self.queue[-1]
+        self.queue.pop()
+        heapq.heapify(self.queue)
+        return entry[2]
+
+    def _rank(self, item):
+        if item is None:
+            return 2, 0
+        try:
+            priority = self.key(item)
+        except Exception:
+            priority = None
+        return (1, 0) if priority is None else (0, priority)
+
+
+class HedgeDelay(object):
+    """
+    How long to wait for a response before racing it against a duplicate: `percentile` of the last `window`
+    latencies, at least `min_delay` seconds - `None` until `min_samples` requests have been timed.
+    """
+    def __init__(self, percentile=95, min_delay=0.05, window=200, min_samples=20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """
+        Seconds to wait for a response before sending the duplicate - `None` while there are too few samples.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies[min(len(latencies) - 1, len(latencies) * self.percentile // 100)])
+
+    def _record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+
+class RequestHedger(HedgeDelay):
+    """
+    Races slow GETs against a duplicate.
+
+    If a response takes longer than `percentile` of the recent ones, the same request is sent again over a
+    connection pool of its own - and through `proxies` (a dict or a callable returning one) if given. Whichever
+    answers first is used, the other response is closed as soon as it arrives. Before `min_samples` requests
+    have been timed nothing is duplicated. The duplicate shares the cookies of the original session.
+
+    `concurrency` is the number of requests expected at the same time. Originals and duplicates have thread
+    pools of that size each, so a duplicate never waits for the originals to finish. The delay counts from when
+    the original is sent, not from when it got queued.
+
+    With a `rate_limiter` a duplicate is only sent if the host is not throttled and a token is free right away.
+    """
+    def __init__(self, percentile=95, proxies=None, min_delay=0.05, window=200, min_samples=20, concurrency=8):
+        super().__init__(percentile=percentile, min_delay=min_delay, window=window, min_samples=min_samples)
+        self.proxies = proxies
+        self.session = requests.Session()
+        self.session.mount('http://', TimedHTTPAdapter())
+        self.session.mount('https://', TimedHTTPAdapter())
+        self.primaries = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='Request')
+        self.hedges = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='Hedged request')
+
+    @staticmethod
+    def _send(session, crawler_name, kwargs, sending=None):
+        if sending:
+            sending.set()
+        _request_context.crawler = crawler_name
+        started = time.monotonic()
+        # only the headers - the loser's body is never read
+        return session.get(stream=True, **kwargs), time.monotonic() - started
+
+    def _on_primary_done(self, future):
+        if future.exception() is None:
+            self._record(future.result()[1])
+
+    @staticmethod
+    def _discard(future):
+        if future.exception() is None:
+            future.result()[0].close()
+
+    @staticmethod
+    def _may_hedge(rate_limiter, url):
+        return rate_limiter is None or (not rate_limiter.throttled(url) and rate_limiter.try_acquire(url))
+
+    def get(self, session, crawler_name, rate_limiter=None, **kwargs):
+        delay = self.delay()
+        if delay is None:
+            response, latency = self._send(session, crawler_name, kwargs)
+            self._record(latency)
+            # read the body here as well, the callers don't expect a stream
+            response.content
+            return response
+        sending = threading.Event()
+        primary = self.primaries.submit(self._send, session, crawler_name, kwargs, sending)
+        primary.add_done_callback(self._on_primary_done)
+        winner = primary
+        # queued behind other originals - that's no reason to duplicate it
+        sending.wait()
+        if not wait([primary], timeout=delay).done and self._may_hedge(rate_limiter, kwargs['url']):
+            proxies = self.proxies() if callable(self.proxies) else self.proxies
+            # whatever the site told the original session applies to the duplicate as well
+            self.session.cookies = session.cookies
+            hedged = self.hedges.submit(
+                self._send, self.session, crawler_name, dict(kwargs, proxies=proxies or kwargs.get('proxies'))
+            )
+            winner = None
+            pending = {primary, hedged}
+            while pending and winner is None:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                winner = next((future for future in done if future.exception() is None), None)
+            for future in pending:
+                future.add_done_callback(self._discard)
+            if winner is None:
+                # both failed - report it like an unhedged request would
+                winner = primary
+            else:
+                Metrics.HEDGED_REQUESTS.inc(crawler=crawler_name, winner='primary' if winner is primary else 'hedge')
+        response = winner.result()[0]
+        response.content
+        return response
+
+
+class Crawler(BaseCrawler):
+    def __init__(
+            self,
+            worker_count=1,
+            name='Crawler',
+            worker_callback: callable = lambda _: "",
+            work_queue: Queue = None,
+            max_pending=0
+    ):
+        """
+        :param work_queue: queue handing the matches to the workers, e.g. a bounded `WorkQueue` or a
+            `PriorityWorkQueue`. Defaults to an unbounded FIFO.
+        :param max_pending: crawls fetching and queueing their matches at a time - `crawl` blocks the caller
+            beyond that, so a full queue pushes back on whoever hands in the links. Unbounded if 0.
+        """
+        super().__init__(name=name, worker_callback=worker_callback)
+        self.workers = []
+        self.worker_ids = itertools.count()
+        # worker -> (since when, match it is busy with, seconds it had waited for the rate limiter by then)
+        self.busy = {}
+        self.abandoned = set()
+        self.workers_lock = threading.Lock()
+
+        self.lock = threading.RLock()
+        self.pending = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.queue = WorkQueue() if work_queue is None else work_queue
+        if isinstance(self.queue, WorkQueue):
+            if self.queue.name is None:
+                self.queue.name = name
+            Metrics.QUEUE_DEPTH.set_function(self.queue.items, crawler=name)
+            Metrics.QUEUE_CAPACITY.set(self.queue.maxsize, crawler=name)
+        else:
+            Metrics.QUEUE_DEPTH.set_function(self.queue.qsize, crawler=name)
+        self.hedger = None
+        self.http_session = requests.Session()
+        self.http_session.mount('http://', TimedHTTPAdapter())
+        self.http_session.mount('https://', TimedHTTPAdapter())
+        # share the http_session if the callback is a crawler-instance
+        # this will probably decrease the number of refused connections
+        if isinstance(worker_callback, Crawler):
+            worker_callback.http_session = self.http_session
+
+        self.worker_count = worker_count
+
+        self.start_workers(worker_count=worker_count, worker_args=[worker_callback])
+
+    def hedge(self, percentile=95, proxies=None, concurrency=8):
+        """
+        Duplicate GETs slower than `percentile` of the recent ones - see `RequestHedger`.
+        `concurrency` is the number of threads fetching through this crawler at the same time.
+        Forms are never submitted twice.
+        """
+        self.hedger = RequestHedger(percentile=percentile, proxies=proxies, concurrency=concurrency)
+        return self
+
+    def _get(self, url, **kwargs):
+        if self.hedger is None:
+            return self.http_session.get(url=url, **kwargs)
+        return self.hedger.get(self.http_session, self.name, rate_limiter=self.rate_limiter, url=url, **kwargs)
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_workers()
+
+    def __del__(self):
+        # never join from the garbage collector - only tell the workers to go home
+        for _ in range(len(self.workers)):
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                break
+
     def _abort(self):
         logging.debug('Received TERMINATE signal. Preparing shutdown.')
         self.abort_workers()
 
-    def abort_workers(self):
+    def abort_workers(self, timeout=None):
+        """
+        Drops the queued matches and stops the workers - see `stop_workers`.
+        """
         try:
             while True:
                 # empty the queue
                 logging.debug('Clearing worker queue')
-                self.queue.get_nowait()
+                item = self.queue.get_nowait()
+                if item is not None:
+                    item.job.task_done()
                 self.queue.task_done()
         except Empty:
             pass
         finally:
             # signal workers to stop
             logging.debug('Worker queue is empty')
-            self.stop_workers()
+            return self.stop_workers(timeout)
 
-    def stop_workers(self):
+    def stop_workers(self, timeout=None):
+        """
+        Lets the workers finish the queued matches and waits at most `timeout` seconds for them to stop.
+        Returns `False` if some of them are still busy.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stopped = True
         with self.lock:
-            for i in range(len(self.workers)):
-                logging.debug('Sending stop-signal to worker [{}]'.format(i))
+            with self.workers_lock:
+                workers = list(self.workers)
+                self.workers.clear()
+            for i in range(len(workers)):
+                logging.debug('Sending stop-signal to worker [%s]', i)
                 self.queue.put(None)
-            for worker in self.workers:
-                worker.join()
-                logging.debug('Worker [{}] stopped.'.format(worker.name))
-            self.workers.clear()
-        return True
+            for worker in workers:
+                worker.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+                if worker.is_alive():
+                    logging.warning('Worker [%s] of %s did not stop in time', worker.name, self.name)
+                    stopped = False
+                else:
+                    logging.debug('Worker [%s] stopped.', worker.name)
+        return stopped
 
     def start_workers(self, worker_count: int, worker_args=None):
-        for i in range(worker_count):
-            worker_name = 'Worker {}'.format(i)
-            logging.debug('Starting worker [{}]'.format(worker_name))
-            t = threading.Thread(target=self.parse, args=worker_args, name=worker_name)
+        for _ in range(worker_count):
+            worker_name = 'Worker {}'.format(next(self.worker_ids))
+            logging.debug('Starting worker [%s]', worker_name)
+            # a stuck worker must not keep the process alive
+            t = threading.Thread(target=self.parse, args=worker_args, name=worker_name, daemon=True)
             t.start()
-            self.workers.append(t)
+            with self.workers_lock:
+                self.workers.append(t)
+
+    def _busy_seconds(self, worker, now):
+        # waiting for the rate limiter is not working on the match
+        since, _, throttled = self.busy[worker]
+        return now - since - (throttled_seconds(worker, now) - throttled)
+
+    def worker_states(self):
+        """
+        Per worker: whether it is alive and for how many seconds it has been busy with its current match - not
+        counting the time it waited for the rate limiter.
+        """
+        now = time.monotonic()
+        with self.workers_lock:
+            return [
+                {
+                    'worker': worker.name,
+                    'alive': worker.is_alive(),
+                    'busy_seconds': self._busy_seconds(worker, now) if worker in self.busy else None,
+                }
+                for worker in self.workers
+            ]
+
+    def stuck_workers(self, budget):
+        """
+        Workers busy with the same match for more than `budget` seconds, rate limiter waits aside.
+        """
+        now = time.monotonic()
+        with self.workers_lock:
+            return [worker for worker in self.busy if self._busy_seconds(worker, now) > budget]
+
+    def abandoned_workers(self):
+        """
+        Number of replaced workers that did not return yet.
+        """
+        with self.workers_lock:
+            return len(self.abandoned)
+
+    def replace_worker(self, worker: threading.Thread):
+        """
+        Gives up on a stuck worker: its match counts as done and a new worker takes its place.
+        Threads can't be killed - the stuck one goes home as soon as it returns.
+        """
+        with self.workers_lock:
+            if worker not in self.workers or worker not in self.busy:
+                return False
+            _, item, _ = self.busy.pop(worker)
+            self.workers.remove(worker)
+            self.abandoned.add(worker)
+        item.job.task_done()
+        self.queue.task_done()
+        self.start_workers(1, worker_args=[self.worker_callback])
+        return True
 
     def parse(self, callback: callable):
-        worker_name = threading.current_thread().getName()
+        worker = threading.current_thread()
+        worker_name = worker.name
         while True:
+            logging.debug('[%s]: waiting for work in queue', worker_name)
+            item = self.queue.get()
+            if item is None:
+                logging.debug('[%s]: no more jobs - going home', worker_name)
+                self.queue.task_done()
+                break
+            with self.workers_lock:
+                self.busy[worker] = time.monotonic(), item, throttled_seconds(worker)
+            abandoned = False
             try:
-                logging.debug('[{}]: waiting for work in queue'.format(worker_name))
-                data = self.queue.get()
-                if data is None:
-                    logging.debug('[{}]: no more jobs - going home'.format(worker_name))
-                    break
-                logging.info('[{}]: got work from queue'.format(worker_name))
-                match = data['match']
-                self._notify_match_found(match, data['source_url'])
+                logging.info('[%s]: got work from queue', worker_name)
+                Metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - item.queued_at, crawler=self.name)
+                self._notify_match_found(item.match, item.source_url, item.first_seen, item.attributes)
                 if hasattr(callback, 'crawl'):
-                    if isinstance(match, lhtml.HtmlElement):
-                        url = match.attrib.get('href')
-                    else:
-                        url = match
-                    callback.crawl(url)
+                    callback.crawl(item.href, first_seen=item.first_seen)
+                elif hasattr(callback, 'handle_match'):
+                    callback.handle_match(self, item.match, item.source_url, item.first_seen)
                 else:
-                    callback(match)
+                    callback(item.match)
+            except Exception as e:
+                logging.warning('[%s]: could not process %s. %s', worker_name, item.href, e)
+                item.job.fail(e)
             finally:
-                if 'data' in locals():
+                with self.workers_lock:
+                    self.busy.pop(worker, None)
+                    abandoned = worker in self.abandoned
+                    self.abandoned.discard(worker)
+                # a replaced worker's match was accounted for already
+                if not abandoned:
+                    item.job.task_done()
                     self.queue.task_done()
-        logging.debug('[{}]: bye'.format(worker_name))
+            if abandoned:
+                logging.info('[%s]: replaced while busy - going home', worker_name)
+                break
+        logging.debug('[%s]: bye', worker_name)
 
-    def crawl(self, url):
-        crawl_thread = threading.Thread(target=self._main_crawler, args=[url], name=self.name + ' - main crawl')
+    def crawl(self, url, params=None, group: CrawlGroup = None, first_seen=None):
+        if self.pending:
+            self.pending.acquire()
+        job = CrawlJob(url, params, group.seen_links if group else None, first_seen)
+        if group:
+            group.jobs.append(job)
+        crawl_thread = threading.Thread(
+            target=self._main_crawler, args=[job], name=self.name + ' - main crawl', daemon=True
+        )
+        job.thread = crawl_thread
         crawl_thread.start()
-        return crawl_thread
-
-    def _main_crawler(self, url):
-        logging.debug('{} started'.format(self.name))
-        self._notify_crawl_started(threading.current_thread())
-        # do the crawl and
-        # queue the extracted targets
-        with self.lock:
-            try:
-                response = self.http_session.get(
-                    url=url,
-                    params=self.params,
-                    headers=self.headers,
-                    timeout=self.connection_timeout,
-                )
-                if response.status_code == 429:
-                    raise TooManyRequestsError()
-                self._notify_progress()
-                html = response.text
-                tree = lhtml.fromstring(html)
-                tree.make_links_absolute(base_url=url)
-                matches = tree.cssselect(self.css_selector)
-                if len(matches) > 0 and len(self.workers) > 0:
-                    logging.info('Found {} links. Queueing for work'.format(len(matches)))
-                    for match in matches:
-                        self.queue.put({'source_url': response.url, 'match': match})
-            except ReadTimeout as rt:
-                logging.info(
-                    'Connection attempt to {} timed out after {} seconds.'.format(
-                        urlparse(rt.request.url).path,
-                        self.connection_timeout
-                    )
-                )
-                self._notify_timeout(url)
-            except TooManyRequestsError:
-                logging.debug('Too many requests made')
-                self._notify_too_many_requests(url)
-            except Exception as e:
-                logging.warning('Could not parse resulting page. {}'.format(e))
-            finally:
-                self.queue.join()
-        logging.debug('{} done'.format(self.name))
-        self._notify_finish()
-
-    def _notify_crawl_started(self, crawl_thread):
-        dispatcher.send(signal=self.SIGNAL_OUT_CRAWL_STARTED, sender=crawl_thread)
+        return job
 
-    def _notify_progress(self):
-        dispatcher.send(signal=self.SIGNAL_OUT_PROGRESS, sender=self)
+    def crawl_sharded(self, url, shards):
+        """
+        Crawls all shards concurrently and merges their matches.
+        """
+        group = CrawlGroup()
+        for params in shards:
+            self.crawl(url, params, group)
+        return group
 
-    def _notify_finish(self):
-        dispatcher.send(signal=self.SIGNAL_OUT_FINISHED, sender=self)
+    def fetch_document(self, url, params=None):
+        """
+        Fetches a single page right away - without queueing anything - and returns its root element with all links
+        made absolute. Raises `TooManyRequestsError` and the `requests` exceptions.
+        """
+        if self.rate_limiter:
+            throttle(self.rate_limiter, url)
+        _request_context.crawler = self.name
+        started = time.monotonic()
+        try:
+            response = self._get(
+                url=url,
+                params=params,
+                headers=self.headers,
+                timeout=self.connection_timeout,
+                proxies=self.proxies,
+            )
+        except ReadTimeout:
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            raise
+        Metrics.FETCH_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        if response.status_code == 429:
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, response.headers.get('Retry-After'))
+            raise TooManyRequestsError(response.headers.get('Retry-After'))
+        if self.rate_limiter:
+            self.rate_limiter.on_success(url)
+        started = time.monotonic()
+        tree = lhtml.fromstring(response.text, base_url=url)
+        tree.make_links_absolute()
+        Metrics.PARSE_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        return tree
 
-    def _notify_too_many_requests(self, requested_url):
-        dispatcher.send(
-            sender=self,
-            signal=self.SIGNAL_OUT_TOO_MANY_REQUESTS,
-            url=requested_url,
-        )
+    def submit(self, form: lhtml.FormElement, extra_values=None):
+        """
+        Submits the form through this crawler's session - sharing its connection pool, headers, proxies,
+        timeout and rate limiter.
 
-    def _notify_timeout(self, requested_url):
-        dispatcher.send(
-            sender=self,
-            signal=self.SIGNAL_OUT_TIMEOUT,
-            url=requested_url,
-        )
+        Returns the root element of the parsed result page.
+        """
+        values = form.form_values()
+        if extra_values:
+            values.extend(extra_values.items() if hasattr(extra_values, 'items') else extra_values)
+        url = form.action or form.base_url
+        method = form.method.upper()
+        if method == 'POST':
+            payload = {'data': values}
+        else:
+            payload = {'params': values}
+        if self.rate_limiter:
+            throttle(self.rate_limiter, url)
+        _request_context.crawler = self.name
+        started = time.monotonic()
+        try:
+            response = self.http_session.request(
+                method,
+                url,
+                headers=self.headers,
+                timeout=self.connection_timeout,
+                proxies=self.proxies,
+                **payload
+            )
+        except ReadTimeout:
+            Metrics.TIMEOUTS.inc(crawler=self.name)
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            raise
+        if response.status_code == 429:
+            Metrics.TOO_MANY_REQUESTS.inc(crawler=self.name)
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, response.headers.get('Retry-After'))
+            raise TooManyRequestsError(response.headers.get('Retry-After'))
+        if self.rate_limiter:
+            self.rate_limiter.on_success(url)
+        document = self._parse_document(response.text, response.url)
+        Metrics.SUBMIT_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+        return document
 
-    def _notify_match_found(self, match, source_url):
-        dispatcher.send(
-            sender=self,
-            signal=self.SIGNAL_OUT_MATCH_FOUND,
-            match=match,
-            source_url=source_url,
-        )
+    def _main_crawler(self, job: CrawlJob):
+        url = job.url
+        logging.debug('%s started', self.name)
+        self._notify_crawl_started(threading.current_thread())
+        # do the crawl and
+        # queue the extracted targets
+        try:
+            params = self.params if job.params is None else job.params
+            page_key = self._page_key(url, params)
+            if self.rate_limiter:
+                throttle(self.rate_limiter, url)
+            _request_context.crawler = self.name
+            started = time.monotonic()
+            response = self._get(
+                url=url,
+                params=params,
+                headers=self._request_headers(page_key),
+                timeout=self.connection_timeout,
+                proxies=self.proxies,
+            )
+            Metrics.FETCH_SECONDS.observe(time.monotonic() - started, crawler=self.name)
+            if response.status_code == 429:
+                raise TooManyRequestsError(response.headers.get('Retry-After'))
+            if self.rate_limiter:
+                self.rate_limiter.on_success(url)
+            self._notify_progress()
+            if response.status_code == 304 or self._page_unchanged(page_key, response.headers, response.content):
+                logging.debug('%s did not change', urlparse(url).path)
+                items = []
+            else:
+                items = self._extract_items(response.text, url, response.url, job)
+                items = self._admit_items(job.unseen(self._changed_items(page_key, items)))
+            if len(items) > 0 and len(self.workers) > 0:
+                logging.info('Found %s links. Queueing for work', len(items))
+                for item in items:
+                    job.add_task()
+                    item.queued_at = time.monotonic()
+                    self.queue.put(item)
+        except ReadTimeout as rt:
+            if self.rate_limiter:
+                self.rate_limiter.on_timeout(url)
+            logging.info(
+                'Connection attempt to %s timed out after %s seconds.',
+                urlparse(rt.request.url).path,
+                self.connection_timeout
+            )
+            job.fail(rt)
+            self._notify_timeout(url)
+        except TooManyRequestsError as tmr:
+            logging.debug('Too many requests made')
+            job.fail(tmr)
+            if self.rate_limiter:
+                self.rate_limiter.on_too_many_requests(url, tmr.retry_after)
+            self._notify_too_many_requests(url)
+        except Exception as e:
+            logging.warning('Could not parse resulting page. %s', e)
+            job.fail(e)
+        finally:
+            # the matches are queued - the next crawl may go
+            if self.pending:
+                self.pending.release()
+            # only wait for the matches queued by this crawl
+            job.seal()
+            job.join()
+        logging.debug('%s done', self.name)
+        self._notify_finish()
 
 
 class TooManyRequestsError(ConnectionRefusedError):
-    pass
+    def __init__(self, retry_after=None):
+        super().__init__()
+        self.retry_after = retry_after
@@ -0,0 +1,200 @@
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future
+from queue import Queue, Empty
+import db
+
+
+class DatabaseManager(object):
+    """
+    Long-lived access to the sqlite database.
+
+    Every thread gets its own connection which stays open - so sqlite's per-connection statement cache keeps the
+    prepared statements around. The database runs in WAL mode so readers don't block the writer.
+    Writes nobody has to wait for are queued with `write` and executed by a single writer thread which batches
+    them into transactions.
+    """
+    def __init__(self, path, batch_size=64, batch_interval=0.1, cached_statements=256):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.cached_statements = cached_statements
+        self.connections = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='Database writer', daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self.connect()
+        return connection
+
+    def execute(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters)
+
+    def seed(self):
+        db.seed(self.connection())
+        return self
+
+    def write(self, *statements) -> Future:
+        """
+        Queues `(sql, parameters)` statements to be executed in one transaction by the writer thread.
+        The returned future is resolved once they are committed.
+        """
+        future = Future()
+        self._writes.put((statements, future))
+        return future
+
+    def flush(self, timeout=None):
+        self.write().result(timeout=timeout)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+
+    def _next_batch(self):
+        batch = [self._writes.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._writes.get(timeout=self.batch_interval))
+            except Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        connection = self.connect()
+        running = True
+        while running:
+            batch = self._next_batch()
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                with connection:
+                    for statements, _ in batch:
+                        for sql, parameters in statements:
+                            connection.execute(sql, parameters)
+            except sqlite3.Error as e:
+                logging.warning('Batched write failed, retrying one by one. %s', e)
+                self._write_separately(connection, batch)
+            else:
+                for _, future in batch:
+                    future.set_result(True)
+
+    @staticmethod
+    def _write_separately(connection, batch):
+        # don't let one broken statement take the whole batch down
+        for statements, future in batch:
+            try:
+                with connection:
+                    for sql, parameters in statements:
+                        connection.execute(sql, parameters)
+            except sqlite3.Error as e:
+                future.set_exception(e)
+            else:
+                future.set_result(True)
+
+
+class ChangeWatcher(object):
+    """
+    Tells when the watched tables changed.
+
+    Triggers count every insert, update and delete of the `tables` in `crawler_changes`. Only that counter is read,
+    so commits to other tables - like the crawler's own bookkeeping - don't count as changes. Without any of the
+    tables `PRAGMA data_version` is used instead, which tells about every commit of somebody else.
+    `watch` polls from a background thread and calls back on every change.
+    """
+    TABLES = ('users_customers', 'buergeramt_appointment')
+
+    def __init__(self, database: DatabaseManager, tables=TABLES):
+        self.connection = database.connect()
+        self.tables = self._install_triggers(self.connection, tables)
+        self.version = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _install_triggers(connection, tables):
+        existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        tables = tuple(table for table in tables if table in existing)
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS `crawler_changes` (name text primary key, changes int default 0)'
+            )
+            for table in tables:
+                connection.execute('INSERT OR IGNORE INTO `crawler_changes` (name) VALUES(?)', (table,))
+                for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                    connection.execute(
+                        'CREATE TRIGGER IF NOT EXISTS `crawler_changes_{table}_{name}` '
+                        'AFTER {operation} ON `{table}` BEGIN '
+                        "UPDATE `crawler_changes` SET changes=changes+1 WHERE name='{table}'; "
+                        'END'.format(table=table, operation=operation, name=operation.lower())
+                    )
+        return tables
+
+    def changed(self):
+        with self.lock:
+            if self.tables:
+                version = self.connection.execute(
+                    'SELECT sum(changes) FROM `crawler_changes` WHERE name IN ({})'.format(
+                        ','.join('?' * len(self.tables))
+                    ),
+                    self.tables
+                ).fetchone()[0]
+            else:
+                version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            changed = version != self.version
+            self.version = version
+        return changed
+
+    def watch(self, callback: callable, interval=0.5):
+        def poll():
+            while not self.stopped.wait(interval):
+                try:
+                    if self.changed():
+                        callback()
+                except Exception as e:
+                    logging.warning('Could not handle database change. %s', e)
+
+        # the first check only records the current version
+        self.changed()
+        self.thread = threading.Thread(target=poll, name='Database change watcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,154 @@
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from queue import Queue, Empty
+
+
+class Event(object):
+    __slots__ = ('signal', 'sender', 'payload', 'time')
+
+    def __init__(self, signal, sender, payload: dict):
+        self.signal = signal
+        self.sender = sender
+        self.payload = payload
+        self.time = time.time()
+
+
+class Subscription(object):
+    """
+    Delivers the events of one signal to one receiver - never on the publishing thread.
+
+    Without an executor events are handed to the receiver one after another by a thread of its own. With an
+    executor every event is a task of its own, so a receiver may handle several events at the same time.
+    If `batch_interval` is set the receiver is called with the list of all events published within the interval
+    instead of once per event.
+    """
+    def __init__(self, signal, receiver: callable, executor: Executor = None, batch_interval=None):
+        self.signal = signal
+        self.receiver = receiver
+        self.executor = executor
+        self.batch_interval = batch_interval
+        self.accepted = self._accepted_arguments(receiver)
+        self.queue = Queue()
+        self.thread = None
+        if executor is None:
+            self.thread = threading.Thread(target=self._deliver_loop, name='Subscriber ' + str(signal), daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def _accepted_arguments(receiver):
+        # like pydispatch: only pass the arguments the receiver asks for
+        try:
+            parameters = inspect.signature(receiver).parameters.values()
+        except (TypeError, ValueError):
+            return None
+        if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters):
+            return None
+        return {p.name for p in parameters}
+
+    def deliver(self, event: Event):
+        if self.executor is not None and self.batch_interval is None:
+            self.executor.submit(self._call, event)
+        else:
+            self.queue.put(event)
+
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+
+    def _call(self, event: Event):
+        try:
+            kwargs = dict(event.payload, sender=event.sender)
+            if self.accepted is not None:
+                kwargs = {key: value for key, value in kwargs.items() if key in self.accepted}
+            self.receiver(**kwargs)
+        except Exception as e:
+            logging.warning('Receiver of %s failed. %s', self.signal, e)
+
+    def _call_batch(self, events):
+        try:
+            self.receiver(events)
+        except Exception as e:
+            logging.warning('Receiver of %s failed. %s', self.signal, e)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_interval
+        while batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _deliver_loop(self):
+        while True:
+            if self.batch_interval is None:
+                event = self.queue.get()
+                if event is None:
+                    break
+                self._call(event)
+                continue
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            events = [event for event in batch if event is not None]
+            if events:
+                if self.executor is not None:
+                    self.executor.submit(self._call_batch, events)
+                else:
+                    self._call_batch(events)
+            if stop:
+                break
+
+
+class EventBus(object):
+    """
+    In-process publish/subscribe replacing the synchronous pydispatch on the crawlers' hot path.
+    Publishing only queues the event - slow receivers never hold up the publisher.
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, signal, receiver: callable, executor: Executor = None, batch_interval=None) -> Subscription:
+        subscription = Subscription(signal, receiver, executor, batch_interval)
+        with self.lock:
+            # copy on write - publish reads without locking
+            subscriptions = dict(self.subscriptions)
+            subscriptions[signal] = subscriptions.get(signal, ()) + (subscription,)
+            self.subscriptions = subscriptions
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscriptions = dict(self.subscriptions)
+            subscriptions[subscription.signal] = tuple(
+                s for s in subscriptions.get(subscription.signal, ()) if s is not subscription
+            )
+            self.subscriptions = subscriptions
+        subscription.close()
+
+    def publish(self, signal, sender=None, **payload):
+        subscriptions = self.subscriptions.get(signal)
+        if not subscriptions:
+            return
+        event = Event(signal, sender, payload)
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+    def close(self):
+        with self.lock:
+            subscriptions = [s for signal_subscriptions in self.subscriptions.values() for s in signal_subscriptions]
+            self.subscriptions = {}
+        for subscription in subscriptions:
+            subscription.close()
+
+
+# used by all crawlers unless told otherwise
+default_bus = EventBus()
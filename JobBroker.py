@@ -0,0 +1,179 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class BrokerJob(object):
+    __slots__ = ('id', 'topic', 'payload', 'attempts')
+
+    def __init__(self, job_id, topic, payload, attempts):
+        self.id = job_id
+        self.topic = topic
+        self.payload = payload
+        self.attempts = attempts
+
+
+class BaseJobBroker(object):
+    """
+    Hands jobs from one crawl stage to another, possibly in another process.
+
+    Delivery is at-least-once: a job taken with `get` is leased for `lease` seconds and handed out again unless it
+    is acknowledged with `ack` before. `nack` makes it available again right away (or after `delay` seconds).
+    """
+    def put(self, topic, payload: dict):
+        raise NotImplementedError()
+
+    def get(self, topic, lease=60, timeout=None) -> BrokerJob:
+        raise NotImplementedError()
+
+    def ack(self, job: BrokerJob):
+        raise NotImplementedError()
+
+    def nack(self, job: BrokerJob, delay=0):
+        raise NotImplementedError()
+
+
+class SqliteJobBroker(BaseJobBroker):
+    """
+    Job broker backed by a sqlite file - shared by all processes on the host that open the same file.
+    """
+    def __init__(self, path, poll_interval=0.2):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS `jobs` (
+    id integer primary key autoincrement,
+    topic text,
+    payload text,
+    available_at real,
+    leased_until real,
+    attempts int default 0
+)''')
+            connection.execute('CREATE INDEX IF NOT EXISTS `jobs_topic` ON `jobs` (topic, available_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are started explicitly
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def put(self, topic, payload: dict):
+        self._connection().execute(
+            "INSERT INTO `jobs` (topic, payload, available_at) VALUES(?,?,?)",
+            (topic, json.dumps(payload), time.time())
+        )
+
+    def get(self, topic, lease=60, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self._lease(topic, lease)
+            if job or (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(self.poll_interval)
+
+    def _lease(self, topic, lease):
+        connection = self._connection()
+        now = time.time()
+        # take the write lock before reading so no other consumer leases the same job
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT id, payload, attempts FROM `jobs` WHERE topic=? AND available_at<=? "
+                "AND (leased_until IS NULL OR leased_until<?) ORDER BY id LIMIT 1",
+                (topic, now, now)
+            ).fetchone()
+            if row:
+                connection.execute(
+                    "UPDATE `jobs` SET leased_until=?, attempts=attempts+1 WHERE id=?",
+                    (now + lease, row[0])
+                )
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        if not row:
+            return None
+        return BrokerJob(row[0], topic, json.loads(row[1]), row[2] + 1)
+
+    def ack(self, job: BrokerJob):
+        self._connection().execute("DELETE FROM `jobs` WHERE id=?", (job.id,))
+
+    def nack(self, job: BrokerJob, delay=0):
+        self._connection().execute(
+            "UPDATE `jobs` SET leased_until=NULL, available_at=? WHERE id=?",
+            (time.time() + delay, job.id)
+        )
+
+
+class BrokerForwarder(object):
+    """
+    Stands in for the downstream crawler of a stage: publishes the links to a broker topic instead.
+    Use it as `worker_callback` of a `Crawler`.
+    """
+    def __init__(self, broker: BaseJobBroker, topic):
+        self.broker = broker
+        self.topic = topic
+
+    def crawl(self, url, params=None, group=None, first_seen=None):
+        self.broker.put(self.topic, {'url': url, 'params': params, 'first_seen': first_seen})
+
+
+class BrokerConsumer(object):
+    """
+    Feeds the jobs of a broker topic to a crawler. A job is acknowledged once its crawl and the handling of its
+    matches are done - it is handed back to the broker if any of it failed or did not finish within the lease.
+    """
+    def __init__(self, broker: BaseJobBroker, topic, crawler, concurrency=1, lease=60, max_attempts=5):
+        self.broker = broker
+        self.topic = topic
+        self.crawler = crawler
+        self.concurrency = concurrency
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._consume, name='{} consumer {}'.format(self.topic, i), daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
+        self.threads.clear()
+
+    def _consume(self):
+        while not self.stopped.is_set():
+            job = self.broker.get(self.topic, lease=self.lease, timeout=1)
+            if job is None:
+                continue
+            if job.attempts > self.max_attempts:
+                logging.warning('Dropping %s job %s after %s attempts', self.topic, job.id, job.attempts - 1)
+                self.broker.ack(job)
+                continue
+            try:
+                crawl_job = self.crawler.crawl(
+                    job.payload['url'],
+                    job.payload.get('params'),
+                    first_seen=job.payload.get('first_seen')
+                )
+                # only ack once the crawl and the workers handling its matches went through
+                if not crawl_job.join(timeout=self.lease):
+                    raise TimeoutError('not done within the lease of {} seconds'.format(self.lease))
+                if crawl_job.error is not None:
+                    raise crawl_job.error
+            except Exception as e:
+                logging.warning('%s job %s failed. %s', self.topic, job.id, e)
+                self.broker.nack(job, delay=job.attempts)
+            else:
+                self.broker.ack(job)
@@ -0,0 +1,219 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+    def as_dict(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in sorted(self.series.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that may go up and down. `set_function` makes the gauge read the value when it is exposed.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[_label_key(labels)] = value
+
+    def set_function(self, function: callable, **labels):
+        self.set(function, **labels)
+
+    def _values(self):
+        with self.lock:
+            series = list(self.series.items())
+        return sorted((key, value() if callable(value) else value) for key, value in series)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        for key, value in self._values():
+            lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+    def as_dict(self):
+        return [{'labels': dict(key), 'value': value} for key, value in self._values()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description='', buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', bound)]), count))
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key, [('le', '+Inf')]), series['count']))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), series['sum']))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), series['count']))
+        return lines
+
+    def as_dict(self):
+        with self.lock:
+            return [
+                {
+                    'labels': dict(key),
+                    'buckets': dict(zip(self.buckets, series['buckets'])),
+                    'sum': series['sum'],
+                    'count': series['count'],
+                }
+                for key, series in sorted(self.series.items())
+            ]
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, metric_class, name, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, *args)
+        return metric
+
+    def counter(self, name, description='') -> Counter:
+        return self._get(Counter, name, description)
+
+    def gauge(self, name, description='') -> Gauge:
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name, description='', buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, buckets)
+
+    def render_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: {'type': metric.kind, 'series': metric.as_dict()} for metric in metrics}
+
+
+class MetricsServer(object):
+    """
+    Exposes a registry on localhost: `/metrics` in the prometheus text format, `/metrics.json` as json.
+    """
+    def __init__(self, metrics_registry: MetricsRegistry, port=9100, host='127.0.0.1'):
+        self.registry = metrics_registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path == '/metrics':
+                    body = self.registry.render_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif handler.path == '/metrics.json':
+                    body = json.dumps(self.registry.as_dict()).encode()
+                    content_type = 'application/json'
+                else:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header('Content-Type', content_type)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='Metrics server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+registry = MetricsRegistry()
+
+CONNECT_SECONDS = registry.histogram('crawler_connect_seconds', 'DNS lookup, TCP connect and TLS handshake')
+FETCH_SECONDS = registry.histogram('crawler_fetch_seconds', 'Time to download a page')
+PARSE_SECONDS = registry.histogram('crawler_parse_seconds', 'Time to parse a page and extract the matches')
+QUEUE_DEPTH = registry.gauge('crawler_queue_depth', 'Matches waiting for a worker')
+QUEUE_CAPACITY = registry.gauge('crawler_queue_capacity', 'Matches a work queue holds at most (0: no limit)')
+QUEUE_DROPPED = registry.counter('crawler_queue_dropped_total', 'Matches dropped from a full work queue')
+QUEUE_COALESCED = registry.counter('crawler_queue_coalesced_total', 'Matches dropped as their link was queued already')
+WORKERS_ALIVE = registry.gauge('crawler_workers_alive', 'Worker threads alive')
+WORKERS_BUSY_SECONDS = registry.gauge('crawler_worker_busy_seconds', 'Longest a worker has been busy with its match')
+WORKER_RESTARTS = registry.counter('crawler_worker_restarts_total', 'Stuck workers replaced')
+QUEUE_WAIT_SECONDS = registry.histogram('crawler_queue_wait_seconds', 'Time a match waited for a worker')
+HEDGED_REQUESTS = registry.counter(
+    'crawler_hedged_requests_total', 'Slow requests raced against a duplicate, by the one answering first'
+)
+SUBMIT_SECONDS = registry.histogram('crawler_submit_seconds', 'Time to submit a form and parse the reply')
+SLOT_TO_BOOKING_SECONDS = registry.histogram(
+    'slot_to_booking_seconds',
+    'Time from a bookable day first showing up to the booking',
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+)
+TOO_MANY_REQUESTS = registry.counter('crawler_too_many_requests_total', 'Requests answered with a 429')
+TIMEOUTS = registry.counter('crawler_timeouts_total', 'Requests that timed out')
+CIRCUIT_RENEWALS = registry.counter('proxy_circuit_renewals_total', 'Tor circuits switched')
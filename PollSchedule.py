@@ -0,0 +1,62 @@
+import threading
+import time
+
+HOURS_PER_WEEK = 7 * 24
+
+
+class PollSchedule(object):
+    """
+    Poll interval following the hours of the week free slots used to show up in.
+
+    Every hour of the week gets a score from the slots first seen in it during the last `weeks` weeks - plus half
+    of those of the hours before and after, plus `smoothing` slots every hour gets for free so a few quiet weeks
+    don't make an hour look dead. The best hour is polled every `min_interval` seconds, the others down to every
+    `max_interval` seconds on a logarithmic scale - but never less than `min_hotness` of the way from the slowest
+    to the fastest interval, as slots do show up in hours that had none so far. The interval stays
+    `default_interval` until the history holds at least `min_slots` slots spread over `min_days` days. The history
+    is reloaded every `reload_interval` seconds.
+    """
+    def __init__(self, slot_history, min_interval=2, max_interval=60, default_interval=5, weeks=4,
+                 reload_interval=3600, min_slots=50, min_days=7, smoothing=1, min_hotness=0.2):
+        self.slot_history = slot_history
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.weeks = weeks
+        self.reload_interval = reload_interval
+        self.min_slots = min_slots
+        self.min_days = min_days
+        self.smoothing = smoothing
+        self.min_hotness = min_hotness
+        self.hotness = None
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        now = time.time()
+        since = now - self.weeks * HOURS_PER_WEEK * 60 * 60
+        counts = self.slot_history.hour_of_week_counts(since)
+        oldest = self.slot_history.oldest(since)
+        if sum(counts) < self.min_slots or oldest is None or now - oldest < self.min_days * 24 * 60 * 60:
+            # too little to tell the hours apart
+            self.hotness = None
+            return
+        scores = [
+            counts[hour] + (counts[hour - 1] + counts[(hour + 1) % HOURS_PER_WEEK]) / 2 + self.smoothing
+            for hour in range(HOURS_PER_WEEK)
+        ]
+        best = max(scores)
+        self.hotness = [max(score / best, self.min_hotness) for score in scores]
+
+    def interval(self, now=None):
+        with self.lock:
+            if self.loaded is None or time.monotonic() - self.loaded > self.reload_interval:
+                self._load()
+                self.loaded = time.monotonic()
+            hotness = self.hotness
+        if hotness is None:
+            return self.default_interval
+        local = time.localtime(now)
+        # tm_wday starts with Monday, the history with Sunday
+        hour = (local.tm_wday + 1) % 7 * 24 + local.tm_hour
+        return self.max_interval * (self.min_interval / self.max_interval) ** hotness[hour]
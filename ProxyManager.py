@@ -1,3 +1,5 @@
+import itertools
+import secrets
 import socket
 import socks
 import requests
@@ -6,13 +8,14 @@ from stem import connection, Signal
 import time
 import threading
 import logging
+import Metrics
 
 
 class BaseProxyManager(object):
     def __init__(self):
         self.lock = threading.RLock()
 
-    def renew_connection(self):
+    def renew_connection(self, crawler=None):
         pass
 
 
@@ -42,8 +45,9 @@ class TorProxyManager(BaseProxyManager):
         self.is_proxy_enabled = False
         return True
 
-    def renew_connection(self):
+    def renew_connection(self, crawler=None):
         logging.debug('Renewing tor-IP address')
+        Metrics.CIRCUIT_RENEWALS.inc(proxy='tor')
         self.lock.acquire()
         # to reach the TOR instance we need to disable the proxy
         previous_proxy_state = self.disable_proxy()
@@ -73,3 +77,59 @@ class TorProxyManager(BaseProxyManager):
             logging.info('ip-address renewed.')
         except ConnectionError:
             self.renew_connection()
+
+
+class TorProxyPool(BaseProxyManager):
+    """
+    Hands every crawler its own Tor circuit instead of proxying the whole process.
+
+    Tor keeps streams with different SOCKS credentials or on different SOCKS ports on separate circuits, so every
+    slot gets one of the `socks_ports` (round robin) and random credentials. The proxy settings are passed per
+    request. Renewing a slot only changes its credentials: the other circuits keep running and nobody has to wait
+    for a NEWNYM.
+    """
+    def __init__(self, socks_ports=(9050,), socks_host='127.0.0.1'):
+        super().__init__()
+        self.socks_host = socks_host
+        self.ports = itertools.cycle(socks_ports)
+        self.slots = {}
+        self.crawlers = {}
+
+    @staticmethod
+    def _slot_key(crawler):
+        return crawler if isinstance(crawler, str) else crawler.name
+
+    def _new_slot(self, port):
+        return port, secrets.token_hex(8), secrets.token_hex(8)
+
+    def proxies_for(self, key):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = self._new_slot(next(self.ports))
+        port, username, password = slot
+        proxy = 'socks5h://{}:{}@{}:{}'.format(username, password, self.socks_host, port)
+        return {'http': proxy, 'https': proxy}
+
+    def assign(self, crawler, key=None):
+        key = key or self._slot_key(crawler)
+        with self.lock:
+            self.crawlers.setdefault(key, []).append(crawler)
+        crawler.set_proxies(self.proxies_for(key))
+        return crawler
+
+    def renew_connection(self, crawler=None):
+        if crawler is None:
+            keys = list(self.slots)
+        else:
+            keys = [self._slot_key(crawler)]
+        for key in keys:
+            with self.lock:
+                port = self.slots[key][0] if key in self.slots else next(self.ports)
+                self.slots[key] = self._new_slot(port)
+                crawlers = list(self.crawlers.get(key, []))
+            logging.debug('Switched circuit of [%s]', key)
+            Metrics.CIRCUIT_RENEWALS.inc(proxy=key)
+            proxies = self.proxies_for(key)
+            for assigned in crawlers:
+                assigned.set_proxies(proxies)
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+
+class TokenBucket(object):
+    """
+    Token bucket handing out reservations.
+
+    Tokens may go negative: a caller always gets its token but is told how long to wait before using it.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        """
+        Takes a token only if it can be used right away.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens < 1 or self.blocked_until > now:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Per-host request rate limiter adapting to the feedback of the server.
+
+    The rate grows additively with every successful request and is cut multiplicatively on 429s and timeouts.
+    A `Retry-After` sent with a 429 blocks the host for the given time.
+    """
+    def __init__(self, initial_rate=2.0, min_rate=0.1, max_rate=20.0, increase=0.05, decrease=0.5, burst=4):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, url) -> TokenBucket:
+        host = urlparse(url).netloc.lower()
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = TokenBucket(self.initial_rate, self.burst)
+        return bucket
+
+    def rate(self, url):
+        with self.lock:
+            return self._bucket(url).rate
+
+    def reserve(self, url):
+        """
+        Takes a token for the host of the url and returns the number of seconds to wait before sending.
+        """
+        with self.lock:
+            return self._bucket(url).reserve()
+
+    def acquire(self, url):
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_acquire(self, url):
+        """
+        Takes a token for the host of the url if a request may be sent right now - never waits.
+        """
+        with self.lock:
+            return self._bucket(url).take()
+
+    def throttled(self, url):
+        """
+        Tells if the host of the url told us to slow down: it is blocked by a `Retry-After` or the rate is still
+        below the initial one.
+        """
+        with self.lock:
+            bucket = self._bucket(url)
+            return bucket.blocked_until > time.monotonic() or bucket.rate < self.initial_rate
+
+    def on_success(self, url):
+        with self.lock:
+            bucket = self._bucket(url)
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+
+    def on_too_many_requests(self, url, retry_after=None):
+        with self.lock:
+            bucket = self._bucket(url)
+            self._decrease(bucket)
+            delay = self.parse_retry_after(retry_after)
+            if delay:
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+                bucket.tokens = min(bucket.tokens, 0)
+
+    def on_timeout(self, url):
+        with self.lock:
+            self._decrease(self._bucket(url))
+
+    def _decrease(self, bucket: TokenBucket):
+        now = time.monotonic()
+        # requests in flight during a congestion all fail together - back off once per congestion
+        if now - bucket.last_decrease < 1 / bucket.rate:
+            return
+        bucket.last_decrease = now
+        bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+        logging.debug('Backing off to %.2f requests/s', bucket.rate)
+
+    @staticmethod
+    def parse_retry_after(retry_after):
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+# shared by all crawlers unless told otherwise
+default_rate_limiter = AdaptiveRateLimiter()
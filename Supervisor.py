@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+import Metrics
+
+
+class Supervisor(object):
+    """
+    Watches the workers of the crawler stages and shuts them down.
+
+    Every stage gets a time budget: a worker busy with a single match for longer - waits for the rate limiter
+    aside - is given up and replaced, see `Crawler.replace_worker`. Replaced workers keep their thread until they
+    return, so a stage gets at most `max_replaced` of them at a time. `request_shutdown` - safe to call from a
+    signal handler - wakes up everybody waiting in `wait`; `shutdown` then gives the stages `drain_timeout`
+    seconds altogether to finish their queued matches.
+    """
+    def __init__(self, check_interval=1.0, max_replaced=8):
+        self.check_interval = check_interval
+        self.max_replaced = max_replaced
+        self.budgets = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def supervise(self, crawler, budget):
+        """
+        Stages are shut down in the order they are supervised in - pass the upstream stages first.
+        """
+        self.budgets[crawler] = budget
+        Metrics.WORKERS_ALIVE.set_function(
+            lambda: sum(state['alive'] for state in crawler.worker_states()),
+            crawler=crawler.name
+        )
+        Metrics.WORKERS_BUSY_SECONDS.set_function(
+            lambda: max([state['busy_seconds'] or 0.0 for state in crawler.worker_states()], default=0.0),
+            crawler=crawler.name
+        )
+        return self
+
+    def start(self):
+        self.thread = threading.Thread(target=self._watch, name='Supervisor', daemon=True)
+        self.thread.start()
+        return self
+
+    def liveness(self):
+        """
+        State of every worker by stage - see `Crawler.worker_states`.
+        """
+        return {crawler.name: crawler.worker_states() for crawler in self.budgets}
+
+    def check(self):
+        for crawler, budget in self.budgets.items():
+            for worker in crawler.stuck_workers(budget):
+                if crawler.abandoned_workers() >= self.max_replaced:
+                    logging.warning(
+                        '%s still has %s replaced workers hanging - not replacing any more',
+                        crawler.name,
+                        self.max_replaced
+                    )
+                    break
+                if crawler.replace_worker(worker):
+                    logging.warning(
+                        '[%s] of %s was busy for more than %ss - replaced', worker.name, crawler.name, budget
+                    )
+                    Metrics.WORKER_RESTARTS.inc(crawler=crawler.name)
+
+    def _watch(self):
+        while not self.stopping.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.warning('Supervisor check failed. %s', e)
+
+    def request_shutdown(self, *args):
+        self.stopping.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for a shutdown request. Returns `True` if there was one.
+        """
+        return self.stopping.wait(timeout)
+
+    def shutdown(self, drain_timeout=10):
+        """
+        Returns `False` if a stage didn't finish its queue in time - its remaining workers are left behind.
+        """
+        self.stopping.set()
+        deadline = time.monotonic() + drain_timeout
+        drained = True
+        for crawler in self.budgets:
+            if not crawler.stop_workers(timeout=max(0.0, deadline - time.monotonic())):
+                logging.warning('%s did not drain in time', crawler.name)
+                drained = False
+        if self.thread:
+            self.thread.join()
+        return drained
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the crawl pipeline.
+
+Runs the crawler chain of `c.py` against a local stand-in for service.berlin.de serving synthetic calendars,
+slot pages and booking forms. Free slots show up at random while the benchmark runs; the stand-in measures how
+long it takes until each of them is booked. Faults (429s, slow responses, timeouts) can be injected.
+
+    ./benchmark.py --duration 120 --too-many-requests 0.05 --slow 0.1 --timeouts 0.01
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import Booking
+import c
+import db
+from DatabaseManager import DatabaseManager
+
+PATH_PREFIX = '/terminvereinbarung/termin/'
+DAY = 24 * 60 * 60
+
+
+class StandIn(object):
+    """
+    State of the fake appointment system: which slots are free, what got booked and how fast.
+    """
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.lock = threading.Lock()
+        self.free_slots = {}
+        self.booked = []
+        self.requests = 0
+        self.faults = {'429': 0, 'slow': 0, 'timeout': 0}
+        self.today = int(time.time()) // DAY * DAY
+        self.stopped = threading.Event()
+
+    def release_slots(self):
+        # new slots appear at random times somewhere in the next month
+        while not self.stopped.wait(random.expovariate(1 / self.arguments.slot_interval)):
+            slot = self.today + random.randrange(1, 30) * DAY + random.randrange(16, 36) * 30 * 60
+            with self.lock:
+                self.free_slots.setdefault(slot, time.time())
+
+    def free_days(self):
+        with self.lock:
+            return sorted({slot // DAY * DAY for slot in self.free_slots})
+
+    def free_slots_of(self, day):
+        with self.lock:
+            return sorted(slot for slot in self.free_slots if slot // DAY * DAY == day)
+
+    def book(self, slot):
+        with self.lock:
+            appeared = self.free_slots.pop(slot, None)
+            if appeared is None:
+                return False
+            self.booked.append(time.time() - appeared)
+            return True
+
+    def inject_fault(self):
+        """
+        Returns the fault to answer the current request with - if any.
+        """
+        with self.lock:
+            self.requests += 1
+            roll = random.random()
+            for fault, rate in (
+                    ('429', self.arguments.too_many_requests),
+                    ('timeout', self.arguments.timeouts),
+                    ('slow', self.arguments.slow),
+            ):
+                if roll < rate:
+                    self.faults[fault] += 1
+                    return fault
+                roll -= rate
+        return None
+
+
+def page(body):
+    return '<html><head><title>Berlin.de</title></head><body><div id="hhibody">{}</div></body></html>'.format(body)
+
+
+def calendar_page(stand_in: StandIn):
+    cells = []
+    free_days = set(stand_in.free_days())
+    for day in range(stand_in.today, stand_in.today + 31 * DAY, DAY):
+        if day in free_days:
+            cells.append('<td class="buchbar"><a href="{}day/{}/">{}</a></td>'.format(
+                PATH_PREFIX, day, time.strftime('%d', time.localtime(day))
+            ))
+        else:
+            cells.append('<td class="nichtbuchbar">{}</td>'.format(time.strftime('%d', time.localtime(day))))
+    return page('<div class="calendar-month-table"><table><tr>{}</tr></table></div>'.format(''.join(cells)))
+
+
+def day_page(stand_in: StandIn, day):
+    rows = ''.join(
+        '<tr><th>{}</th><td class="frei"><a href="{}time/{}/">Amt</a></td></tr>'.format(
+            time.strftime('%H:%M', time.localtime(slot)), PATH_PREFIX, slot
+        )
+        for slot in stand_in.free_slots_of(day)
+    )
+    return page('<table class="timetable">{}</table>'.format(rows))
+
+
+def form_page(slot):
+    return page(
+        '<div></div><div id="kundendaten"><form action="{}register/" method="post">'
+        '<input type="hidden" name="slot" value="{}">'
+        '<input type="text" name="Nachname"><input type="text" name="EMail"><input type="text" name="telefon">'
+        '<input type="checkbox" name="agbgelesen" value="1">'
+        '<input type="submit" value="Termin eintragen"></form></div>'.format(PATH_PREFIX, slot)
+    )
+
+
+def confirmation_page(token):
+    return page(
+        '<div></div><div></div><div>Vorgangsnummer <span class="number-red-big">{}</span></div>'.format(token)
+    )
+
+
+def make_handler(stand_in: StandIn):
+    class StandInHandler(BaseHTTPRequestHandler):
+        def _respond(self, status, body='', headers=None):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _faulty(self):
+            fault = stand_in.inject_fault()
+            if fault == '429':
+                self._respond(429, page('Zu viele Zugriffe'), {'Retry-After': '1'})
+                return True
+            if fault == 'timeout':
+                time.sleep(stand_in.arguments.timeout_delay)
+                # never answered - the client gave up long ago
+                self.close_connection = True
+                return True
+            if fault == 'slow':
+                time.sleep(stand_in.arguments.slow_delay)
+            return False
+
+        def do_GET(self):
+            if self._faulty():
+                return
+            parts = self.path.split('?')[0][len(PATH_PREFIX):].strip('/').split('/')
+            if parts[0] == 'tag.php':
+                self._respond(200, calendar_page(stand_in))
+            elif parts[0] == 'day' and len(parts) > 1:
+                self._respond(200, day_page(stand_in, int(parts[1])))
+            elif parts[0] == 'time' and len(parts) > 1:
+                self._respond(200, form_page(int(parts[1])))
+            else:
+                self._respond(404, page('Nicht gefunden'))
+
+        def do_POST(self):
+            if self._faulty():
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            values = parse_qs(self.rfile.read(length).decode())
+            slot = int(values.get('slot', ['0'])[0])
+            if stand_in.book(slot):
+                self._respond(200, confirmation_page('{:08d}'.format(random.randrange(10 ** 8))))
+            else:
+                self._respond(200, page('Der Termin ist leider nicht mehr frei.'))
+
+        def log_message(self, *args):
+            pass
+
+    return StandInHandler
+
+
+def seed_customers(path, count):
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+CREATE TABLE buergeramt_appointment (id integer primary key, service_id int, cancel_token text);
+CREATE TABLE users_customers (
+    id integer primary key, name text, phone text, mail text, appointment_id int, confirmation_blob blob
+);''')
+    for i in range(1, count + 1):
+        connection.execute("INSERT INTO buergeramt_appointment VALUES(?,?,NULL)", (i, 121151))
+        connection.execute(
+            "INSERT INTO users_customers VALUES(?,?,?,?,?,NULL)",
+            (i, 'Kunde {}'.format(i), '030{:07d}'.format(i), 'kunde{}@example.org'.format(i), i)
+        )
+    connection.commit()
+    connection.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def run(arguments):
+    stand_in = StandIn(arguments)
+    server = ThreadingHTTPServer(('127.0.0.1', arguments.port), make_handler(stand_in))
+    threading.Thread(target=server.serve_forever, name='Stand-in server', daemon=True).start()
+    threading.Thread(target=stand_in.release_slots, name='Slot release', daemon=True).start()
+    base_url = 'http://127.0.0.1:{}{}'.format(server.server_address[1], PATH_PREFIX)
+
+    work_dir = tempfile.mkdtemp(prefix='buergeramt_benchmark_')
+    os.chdir(work_dir)
+    seed_customers(os.path.join(work_dir, 'buergeramt.db'), arguments.customers)
+
+    tracemalloc.start()
+    c.database = DatabaseManager(os.path.join(work_dir, 'buergeramt.db'))
+    c.customers = db.CustomerQueue(c.database).refresh()
+    c.slot_history = db.SlotHistory(c.database)
+    c.subscribe_receivers()
+
+    crawler_arguments = c.parse_args(['--shard-size', str(arguments.shard_size)])
+    if arguments.use_async:
+        form_crawler = c.build_async_form_crawler()
+        fast_path = Booking.AsyncBookingFastPath(form_crawler, c.customers, on_booked=c.on_slot_booked)
+        details_crawler = c.build_async_details_crawler(fast_path)
+        calendar_crawler = c.build_async_calendar_crawler(details_crawler, crawler_arguments)
+    else:
+        form_crawler = c.build_form_crawler(Booking.FormBooking(c.customers, on_booked=c.on_slot_booked))
+        fast_path = None
+        if not arguments.no_fast_path:
+            fast_path = Booking.BookingFastPath(form_crawler, c.customers, on_booked=c.on_slot_booked)
+        details_crawler = c.build_details_crawler(fast_path or form_crawler)
+        calendar_crawler = c.build_calendar_crawler(details_crawler, crawler_arguments)
+    crawlers = [form_crawler, details_crawler, calendar_crawler]
+    c.crawlers.update((crawler.name, crawler) for crawler in crawlers)
+    if arguments.no_rate_limit:
+        for crawler in crawlers:
+            crawler.set_rate_limiter(None)
+
+    started = time.monotonic()
+    if arguments.use_async:
+        poller = threading.Thread(
+            target=asyncio.run,
+            args=[c.run_async_pipeline(
+                crawlers, calendar_crawler, crawler_arguments, base_url + 'tag.php', fast_path=fast_path
+            )],
+            name='Calendar poll',
+            daemon=True
+        )
+    else:
+        poller = threading.Thread(
+            target=c.poll_calendar,
+            args=[calendar_crawler, crawler_arguments, base_url + 'tag.php'],
+            kwargs={'fast_path': fast_path},
+            name='Calendar poll',
+            daemon=True
+        )
+    poller.start()
+    time.sleep(arguments.duration)
+    c.supervisor.request_shutdown()
+    stand_in.stopped.set()
+    elapsed = time.monotonic() - started
+    poller.join(timeout=30)
+    if not arguments.use_async:
+        for crawler in crawlers:
+            crawler.abort_workers()
+    if fast_path:
+        fast_path.release()
+    c.database.close()
+    server.shutdown()
+
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = sorted(stand_in.booked)
+    return {
+        'duration_seconds': round(elapsed, 1),
+        'requests': stand_in.requests,
+        'requests_per_second': round(stand_in.requests / elapsed, 2),
+        'faults': stand_in.faults,
+        'slots_released': len(latencies) + len(stand_in.free_slots),
+        'slots_booked': len(latencies),
+        'slot_to_booking_p50_seconds': percentile(latencies, 50),
+        'slot_to_booking_p99_seconds': percentile(latencies, 99),
+        'peak_python_memory_bytes': peak_traced,
+        'peak_rss_kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the crawler against a local stand-in.')
+    parser.add_argument('--duration', help='seconds to run', type=float, default=60)
+    parser.add_argument('--port', help='port of the stand-in (0: any free port)', type=int, default=0)
+    parser.add_argument('--customers', help='customers waiting for an appointment', type=int, default=100)
+    parser.add_argument('--slot-interval', help='mean seconds between new free slots', type=float, default=2)
+    parser.add_argument('--too-many-requests', help='share of requests answered with 429', type=float, default=0)
+    parser.add_argument('--slow', help='share of slow responses', type=float, default=0)
+    parser.add_argument('--slow-delay', help='seconds a slow response takes', type=float, default=2)
+    parser.add_argument('--timeouts', help='share of requests never answered in time', type=float, default=0)
+    parser.add_argument('--timeout-delay', help='seconds before giving up on a request', type=float, default=30)
+    parser.add_argument('--shard-size', help='as for c.py', type=int, default=0)
+    parser.add_argument('--no-fast-path', help='book through the queued form crawler', action='store_true')
+    parser.add_argument('--no-rate-limit', help='disable the adaptive rate limiter', action='store_true')
+    parser.add_argument('--async', help='run the pipeline on one asyncio event loop', dest='use_async',
+                        action='store_true')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    # the receivers of c.py print their progress - keep stdout for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(parse_args(sys.argv[1:]))
+    print(json.dumps(results, indent=2))
@@ -5,16 +5,25 @@ import argparse
 import time
 import logging
 import atexit
+import asyncio
+import functools
+import threading
 
 import datetime
-from lxml import etree
-import lxml.html as lhtml
-import sqlite3
+import re
+from urllib.parse import urlparse, parse_qs
 import json_log_filter
 import db
-from pypoeci import Crawler
-from ProxyManager import TorProxyManager
-from pydispatch import dispatcher
+from DatabaseManager import DatabaseManager, ChangeWatcher
+from Crawlers import Crawler, WorkQueue, PriorityWorkQueue, UrlFrontier
+from AsyncCrawlers import AsyncCrawler
+import Booking
+from PollSchedule import PollSchedule
+from Supervisor import Supervisor
+from ProxyManager import TorProxyPool
+from JobBroker import SqliteJobBroker, BrokerForwarder, BrokerConsumer
+from EventBus import default_bus
+import Metrics
 
 os.chdir(os.path.dirname(__file__))
 
@@ -27,6 +36,32 @@ BASE_URL = u'https://service.berlin.de/terminvereinbarung/termin/'
 URL_CALENDAR = BASE_URL + u'tag.php'
 URL_DETAILS = u'termin.php'
 
+DAY_RECHECK_INTERVAL = 60  # seconds
+DAY = 24 * 60 * 60  # seconds
+DEFAULT_WINDOW_DAYS = 90
+MONTHS_PER_PAGE = 2  # tag.php shows two months at a time
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+# the pipeline may run in one process or split into stages talking through a job broker
+STAGE_ALL = 'all'
+STAGE_CALENDAR = 'calendar'
+STAGE_DETAILS = 'details'
+STAGE_FORM = 'form'
+
+# capacity and policy of each stage's work queue, see `WorkQueue`
+STAGE_QUEUES = {
+    STAGE_CALENDAR: (256, WorkQueue.COALESCE),
+    STAGE_DETAILS: (256, WorkQueue.COALESCE),
+    # an old form most likely is for a slot that is gone already
+    STAGE_FORM: (16, WorkQueue.DROP_OLDEST),
+}
+# seconds a worker of each stage may spend on one match before it is replaced
+STAGE_BUDGETS = {
+    STAGE_CALENDAR: 30,
+    STAGE_DETAILS: 60,
+    STAGE_FORM: 60,
+}
+
 param_service_ids = [  # dienstleister
     '122210', '122217', '122219', '122227', '122231', '122238', '122243', '122252', '122260', '122262', '122254',
     '122271', '122273', '122277', '122280', '122282', '122284', '122291', '122285', '122286', '122296', '150230',
@@ -49,50 +84,286 @@ param_request = [  # anliegen
 
 crawl_threads = []
 crawlers = {}
-run = True
+day_frontier = UrlFrontier(ttl=DAY_RECHECK_INTERVAL)
+supervisor = Supervisor()
 
 
-def get_date(start_date):
-    if start_date:
-        pass
-    else:
+def url_timestamp(url):
+    """
+    Days and slots are linked by their unix timestamp, e.g. `/termin/time/1450085400/`.
+    """
+    timestamp = re.search(r'/(\d{9,11})/', url or '')
+    return int(timestamp.group(1)) if timestamp else None
+
+
+def link_timestamp(item):
+    return url_timestamp(item.href)
+
+
+def slot_key(url, location=None):
+    """
+    Location, service and time of the slot a link points to.
+
+    Slot links on the live site carry no query: the location is then the one the link is labelled with and the
+    service the ones asked for.
+    """
+    query = parse_qs(urlparse(url).query)
+    services = requested_services.services if requested_services else []
+    return (
+        ','.join(query.get('dienstleister', query.get('dienstleister[]', []))) or location or '',
+        ','.join(query.get('anliegen', query.get('anliegen[]', []))) or ','.join(str(service) for service in services),
+        url_timestamp(url),
+    )
+
+
+def get_date(date_string):
+    """
+    Unix timestamp of the given day (`YYYY-MM-DD` or `DD.MM.YYYY`), of now if there is none.
+    """
+    if not date_string:
         return int(time.time())
+    for date_format in DATE_FORMATS:
+        try:
+            return int(time.mktime(time.strptime(date_string, date_format)))
+        except ValueError:
+            continue
+    raise ValueError('Unknown date format: {}'.format(date_string))
+
+
+def queue_setting(value):
+    """
+    Parses `STAGE=SIZE[:POLICY]`, e.g. `details=100:drop_oldest`.
+    """
+    stage, _, setting = value.partition('=')
+    size, _, policy = setting.partition(':')
+    if stage not in STAGE_QUEUES:
+        raise ValueError('Unknown stage: {}'.format(stage))
+    policy = policy or STAGE_QUEUES[stage][1]
+    if policy not in WorkQueue.POLICIES:
+        raise ValueError('Unknown queue policy: {}'.format(policy))
+    return stage, (int(size), policy)
+
+
+def budget_setting(value):
+    """
+    Parses `STAGE=SECONDS`, e.g. `form=30`.
+    """
+    stage, _, seconds = value.partition('=')
+    if stage not in STAGE_BUDGETS:
+        raise ValueError('Unknown stage: {}'.format(stage))
+    return stage, float(seconds)
+
+
+def start_of_day(timestamp):
+    return int(time.mktime(datetime.date.fromtimestamp(timestamp).timetuple()))
+
+
+def date_window(arguments):
+    """
+    Start and end (exclusive) of the days to look for appointments in.
+    Without `--start_date` the window moves along with today.
+    """
+    start = start_of_day(arguments.start_date or get_date(None))
+    if arguments.end_date:
+        end = start_of_day(arguments.end_date) + DAY
+    else:
+        end = start + DEFAULT_WINDOW_DAYS * DAY
+    return start, max(start + DAY, end)
+
+
+def calendar_pages(start, end):
+    """
+    `Datum` of each calendar page needed to see all days from `start` to `end`.
+    """
+    month = datetime.date.fromtimestamp(start)
+    month = month.year * 12 + month.month - 1
+    last = datetime.date.fromtimestamp(end - 1)
+    last = last.year * 12 + last.month - 1
+    pages = [start]
+    for month in range(month + MONTHS_PER_PAGE, last + 1, MONTHS_PER_PAGE):
+        pages.append(int(time.mktime(datetime.date(month // 12, month % 12 + 1, 1).timetuple())))
+    return pages
+
+
+def in_window(arguments):
+    def predicate(item):
+        timestamp = link_timestamp(item)
+        if timestamp is None:
+            # links without a date can't be judged
+            return True
+        start, end = date_window(arguments)
+        return start <= timestamp < end
+    return predicate
 
 
 pm = None
+database = None
+customers = None
+slot_history = None
+requested_services = None
 
 
 def main(args):
-    logging.basicConfig(
-        format='{"time": "%(asctime)s", "level": "%(levelname)s", "source": "%(module)s", "message": %(message)s}',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        filename=os.getcwd() + '/buergeramt.log',
-        level=logging.DEBUG
+    arguments = parse_args(args)
+    # formatting and writing the log happens off the crawl threads
+    log_listener = json_log_filter.enable_queue_logging(
+        os.getcwd() + '/buergeramt.log',
+        level=logging.getLevelName(arguments.log_level)
     )
-
-    json_log_filter.enable_filter()
+    atexit.register(log_listener.stop)
 
     #  don't show the TRACEs from stem in the logs
     logging.getLogger('stem').addFilter(lambda rec: rec.levelname.upper() != 'TRACE')
 
-    #db.seed(sqlite3.connect(USER_DB))
+    global database
+    database = DatabaseManager(USER_DB)
+    atexit.register(database.close)
+    #database.seed()
+    global slot_history
+    slot_history = db.SlotHistory(database)
 
     logging.info('Start searching for free appointments')
-    arguments = parse_args(args)
+    if arguments.metrics_port:
+        Metrics.MetricsServer(Metrics.registry, port=arguments.metrics_port).start()
     if arguments.tor:
         global pm
         logging.debug('TOR enabled')
-        pm = TorProxyManager(9051, 'test')
-        pm.enable_proxy()
+        pm = TorProxyPool(socks_ports=[int(port) for port in arguments.tor_ports.split(',')])
+
+    subscribe_receivers()
+
+    broker = None
+    if arguments.stage != STAGE_ALL:
+        broker = SqliteJobBroker(arguments.broker)
+
+    queues = dict(STAGE_QUEUES, **dict(arguments.queue or ()))
+
+    global customers
+    form_crawler = None
+    if arguments.use_async:
+        customers = db.CustomerQueue(database).refresh()
+        form_crawler = build_async_form_crawler()
+    elif arguments.stage in (STAGE_ALL, STAGE_FORM):
+        customers = db.CustomerQueue(database).refresh()
+        form_crawler = build_form_crawler(
+            Booking.FormBooking(customers, on_booked=on_slot_booked),
+            queues[STAGE_FORM]
+        )
+
+    fast_path = None
+    if arguments.use_async:
+        # the whole pipeline runs on one event loop
+        fast_path = Booking.AsyncBookingFastPath(form_crawler, customers, on_booked=on_slot_booked)
+    elif arguments.stage == STAGE_ALL and not arguments.no_fast_path:
+        # fetch, fill in and submit the form as soon as a free slot shows up
+        fast_path = Booking.BookingFastPath(form_crawler, customers, on_booked=on_slot_booked)
+    if fast_path:
+        fast_path.prefetch_customers()
+        atexit.register(fast_path.release)
+
+    details_crawler = None
+    if arguments.use_async:
+        details_crawler = build_async_details_crawler(fast_path, queues[STAGE_DETAILS])
+    elif arguments.stage in (STAGE_ALL, STAGE_DETAILS):
+        if arguments.stage == STAGE_DETAILS:
+            details_callback = BrokerForwarder(broker, STAGE_FORM)
+        else:
+            details_callback = fast_path or form_crawler
+        details_crawler = build_details_crawler(details_callback, queues[STAGE_DETAILS])
+
+    calendar_crawler = None
+    if arguments.use_async:
+        calendar_crawler = build_async_calendar_crawler(details_crawler, arguments, queues[STAGE_CALENDAR])
+    elif arguments.stage in (STAGE_ALL, STAGE_CALENDAR):
+        calendar_crawler = build_calendar_crawler(
+            details_crawler if arguments.stage == STAGE_ALL else BrokerForwarder(broker, STAGE_DETAILS),
+            arguments,
+            queues[STAGE_CALENDAR]
+        )
+
+    crawlers.update(
+        (crawler.name, crawler) for crawler in [form_crawler, details_crawler, calendar_crawler] if crawler
+    )
+
+    if pm:
+        for crawler in [form_crawler, details_crawler, calendar_crawler]:
+            if crawler:
+                pm.assign(crawler)
+                if crawler.hedger:
+                    # duplicates of slow requests go over a circuit of their own
+                    crawler.hedger.proxies = functools.partial(pm.proxies_for, crawler.name + ' hedge')
+
+    global requested_services
+    requested_services = db.RequestedServices(database)
+
+    def on_database_changed():
+        if calendar_crawler and requested_services.refresh():
+            calendar_crawler.add_param('anliegen', requested_services.services)
+        if customers:
+            customers.refresh()
+        if fast_path:
+            fast_path.prefetch_customers()
+
+    # upstream stages first - they drain into the downstream ones
+    budgets = dict(STAGE_BUDGETS, **dict(arguments.budget or ()))
+    for stage, crawler in ((STAGE_CALENDAR, calendar_crawler), (STAGE_DETAILS, details_crawler),
+                           (STAGE_FORM, form_crawler)):
+        # async stages have no workers to look after
+        if isinstance(crawler, Crawler):
+            supervisor.supervise(crawler, budgets[stage])
+    supervisor.start()
+
+    on_database_changed()
+    # only touch the tables when somebody changed them
+    change_watcher = ChangeWatcher(database).watch(on_database_changed)
+
+    consumers = []
+    if arguments.stage == STAGE_DETAILS:
+        consumers.append(BrokerConsumer(broker, STAGE_DETAILS, details_crawler, concurrency=8).start())
+    elif arguments.stage == STAGE_FORM:
+        consumers.append(BrokerConsumer(broker, STAGE_FORM, form_crawler, concurrency=2).start())
+
+    if calendar_crawler:
+        schedule = PollSchedule(
+            slot_history,
+            min_interval=arguments.min_poll_interval,
+            max_interval=arguments.max_poll_interval
+        )
+        if arguments.use_async:
+            asyncio.run(run_async_pipeline(
+                [calendar_crawler, details_crawler, form_crawler], calendar_crawler, arguments, schedule=schedule,
+                fast_path=fast_path
+            ))
+        else:
+            poll_calendar(calendar_crawler, arguments, schedule=schedule, fast_path=fast_path)
+    else:
+        supervisor.wait()
+
+    logging.info('Shutting down')
+    deadline = time.monotonic() + arguments.drain_timeout
+    for consumer in consumers:
+        consumer.stop()
+    supervisor.shutdown(drain_timeout=max(0.0, deadline - time.monotonic()))
+    change_watcher.stop()
+    for thread in list(crawl_threads):
+        thread.join(max(0.0, deadline - time.monotonic()))
+    crawl_threads.clear()
+
+    logging.debug("END")
+    sys.exit(0)
 
-    dispatcher.connect(receiver=on_crawl_started, signal=Crawler.SIGNAL_OUT_CRAWL_STARTED)
-    dispatcher.connect(receiver=on_crawler_progress, signal=Crawler.SIGNAL_OUT_PROGRESS)
-    dispatcher.connect(receiver=on_crawler_stressed, signal=Crawler.SIGNAL_OUT_TOO_MANY_REQUESTS)
-    dispatcher.connect(receiver=on_crawler_timeout, signal=Crawler.SIGNAL_OUT_TIMEOUT)
-    dispatcher.connect(receiver=on_crawler_terminated, signal=Crawler.SIGNAL_OUT_TERMINATED)
-    dispatcher.connect(receiver=on_crawler_match, signal=Crawler.SIGNAL_OUT_MATCH_FOUND)
 
-    form_crawler = Crawler(worker_count=1, name='Form Filter')
+def subscribe_receivers(bus=default_bus):
+    # the receivers run off the crawl threads - progress and matches are handled in batches
+    bus.subscribe(Crawler.SIGNAL_OUT_CRAWL_STARTED, on_crawl_started)
+    bus.subscribe(Crawler.SIGNAL_OUT_PROGRESS, on_crawler_progress, batch_interval=0.5)
+    bus.subscribe(Crawler.SIGNAL_OUT_TOO_MANY_REQUESTS, on_crawler_stressed)
+    bus.subscribe(Crawler.SIGNAL_OUT_TIMEOUT, on_crawler_timeout)
+    # the form crawler's workers book the slots themselves
+    bus.subscribe(Crawler.SIGNAL_OUT_MATCH_FOUND, on_slots_found, batch_interval=1.0)
+
+
+def configure_form_crawler(form_crawler):
     form_crawler \
         .set_timeout(5) \
         .set_selector('#kundendaten form') \
@@ -100,152 +371,237 @@ def main(args):
             'User-Agent',
             'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2490.80 Safari/537.36'
         )
+    return form_crawler
+
+
+def build_form_crawler(worker_callback=lambda _: "", queue=STAGE_QUEUES[STAGE_FORM]):
+    size, policy = queue
+    form_crawler = Crawler(
+        worker_count=1,
+        name='Form Filter',
+        worker_callback=worker_callback,
+        work_queue=WorkQueue(size, policy),
+        max_pending=8
+    )
+    return configure_form_crawler(form_crawler.hedge(concurrency=8))
+
+
+def build_async_form_crawler():
+    # only fetches and submits the forms for the fast path
+    return configure_form_crawler(AsyncCrawler(worker_count=4, name='Form Filter').hedge())
+
 
-    details_crawler = Crawler(worker_count=8, name='Details Crawler', worker_callback=form_crawler)
+def configure_details_crawler(details_crawler):
     details_crawler.set_timeout(15)
-    details_crawler.set_selector('.navigation a')
     details_crawler.set_selector("td[class~='{}']>a".format(CSS_CLASS_FREE_APPOINTMENT))
+    # the link text names the location
+    details_crawler.extract_links(keep_text=True)
     details_crawler.add_header(
         'User-Agent',
         'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2490.80 Safari/537.36'
     )
+    return details_crawler
+
+
+def build_details_crawler(worker_callback, queue=STAGE_QUEUES[STAGE_DETAILS]):
+    size, policy = queue
+    # the earliest slots are gone first - try them first
+    details_crawler = Crawler(
+        worker_count=8,
+        name='Details Crawler',
+        worker_callback=worker_callback,
+        work_queue=PriorityWorkQueue(key=link_timestamp, maxsize=size, policy=policy),
+        # the calendar workers wait while the details queue is full
+        max_pending=16
+    )
+    # a slot is gone by the time a hanging request times out
+    # one crawl thread per day being checked
+    details_crawler.hedge(concurrency=16)
+    return configure_details_crawler(details_crawler)
+
+
+def build_async_details_crawler(worker_callback, queue=STAGE_QUEUES[STAGE_DETAILS]):
+    size, _ = queue
+    details_crawler = AsyncCrawler(
+        worker_count=8,
+        name='Details Crawler',
+        worker_callback=worker_callback,
+        max_pending=size
+    )
+    # a slot is gone by the time a hanging request times out
+    return configure_details_crawler(details_crawler.hedge())
 
-    #  calendar_crawler = Crawler(worker_count=4, name='Calendar crawler', worker_callback=calendar_callback)
-    calendar_crawler = Crawler(worker_count=4, name='Calendar crawler', worker_callback=details_crawler)
+
+def configure_calendar_crawler(calendar_crawler, arguments):
     calendar_crawler.add_header(
         'User-Agent',
         'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2490.80 Safari/537.36'
     )
     calendar_crawler.set_timeout(10)
-    calendar_crawler.add_param('Datum', get_date(arguments.start_date))
+    calendar_crawler.add_param('Datum', date_window(arguments)[0])
     calendar_crawler.add_param('termin', 1)
     calendar_crawler.add_param('dienstleister', param_service_ids)
     calendar_crawler.add_param('anliegen', param_request)
 
-    calendar_crawler.set_selector(".indexlist_item a")
     calendar_crawler.set_selector("td[class~='{}']>a".format(CSS_CLASS_RESERVABLE))
+    calendar_crawler.extract_links()
+    # only hand on days inside the date window
+    calendar_crawler.filter_matches(in_window(arguments))
+    # don't re-check the same day on every poll
+    calendar_crawler.set_frontier(day_frontier)
+    # only hand on days that became bookable since the last poll
+    calendar_crawler.detect_changes(recheck_after=DAY_RECHECK_INTERVAL)
+    return calendar_crawler
+
+
+def build_calendar_crawler(worker_callback, arguments, queue=STAGE_QUEUES[STAGE_CALENDAR]):
+    size, policy = queue
+    #  calendar_crawler = Crawler(worker_count=4, name='Calendar crawler', worker_callback=calendar_callback)
+    calendar_crawler = Crawler(
+        worker_count=4,
+        name='Calendar crawler',
+        worker_callback=worker_callback,
+        work_queue=PriorityWorkQueue(key=link_timestamp, maxsize=size, policy=policy),
+        # the next poll waits while the calendar queue is full
+        max_pending=8
+    )
+    return configure_calendar_crawler(calendar_crawler, arguments)
+
 
-    while run:
-        u = sqlite3.connect(USER_DB)
-        u.row_factory = sqlite3.Row
-        db_cursor = u.cursor()
+def build_async_calendar_crawler(worker_callback, arguments, queue=STAGE_QUEUES[STAGE_CALENDAR]):
+    size, _ = queue
+    calendar_crawler = AsyncCrawler(
+        worker_count=4,
+        name='Calendar crawler',
+        worker_callback=worker_callback,
+        max_pending=size
+    )
+    return configure_calendar_crawler(calendar_crawler, arguments)
+
+
+def calendar_requests(calendar_crawler, arguments):
+    """
+    Parameters of every calendar page to request in one poll.
+    """
+    window = date_window(arguments)
+    if arguments.shard_size:
+        # one slow or refused shard doesn't hold up the others
+        shards = calendar_crawler.shards(dienstleister=arguments.shard_size)
+        # several calendar processes split the shards between them
+        shards = shards[arguments.shard_index::arguments.shard_count]
+    else:
+        shards = [dict(calendar_crawler.params)]
+    # all months of the window at once
+    return [dict(shard, Datum=page) for shard in shards for page in calendar_pages(*window)]
+
+
+def poll_calendar(calendar_crawler: Crawler, arguments, url=URL_CALENDAR, schedule: PollSchedule = None,
+                  fast_path: Booking.BookingFastPath = None):
+    last_refresh = time.monotonic()
+    while not supervisor.stopping.is_set():
         try:
-            requested_services = []
-            res = db_cursor.execute("SELECT service_id from users_customers as u CROSS JOIN buergeramt_appointment as a on u.appointment_id=a.id group by service_id")
-            rows = res.fetchall()
-            for row in rows:
-                requested_services.append(row['service_id'])
-            calendar_crawler.add_param('anliegen', requested_services)
-            ct = calendar_crawler.crawl(URL_CALENDAR)
+            if customers and time.monotonic() - last_refresh > customers.claim_timeout / 2:
+                # the customers claimed in advance are not abandoned
+                if fast_path:
+                    fast_path.renew_claims()
+                # release abandoned claims even if nothing else changes
+                customers.refresh()
+                last_refresh = time.monotonic()
+            ct = calendar_crawler.crawl_sharded(url, calendar_requests(calendar_crawler, arguments))
             ct.join()
         except Exception:
             pass
-        finally:
-            db_cursor.close()
-            u.close()
 
-        time.sleep(5)
+        # poll more often when slots used to show up
+        supervisor.wait(schedule.interval() if schedule else 5)
 
-    for thread in crawl_threads:
-        thread.join()
-        crawl_threads.remove(thread)
 
-    logging.debug("END")
-    sys.exit(0)
+async def poll_calendar_async(calendar_crawler: AsyncCrawler, arguments, url=URL_CALENDAR,
+                              schedule: PollSchedule = None, fast_path: Booking.AsyncBookingFastPath = None):
+    # the database and the supervisor are only used off the event loop
+    loop = asyncio.get_running_loop()
+    last_refresh = time.monotonic()
+    while not supervisor.stopping.is_set():
+        try:
+            if customers and time.monotonic() - last_refresh > customers.claim_timeout / 2:
+                # the customers claimed in advance are not abandoned
+                if fast_path:
+                    await loop.run_in_executor(None, fast_path.renew_claims)
+                # release abandoned claims even if nothing else changes
+                await loop.run_in_executor(None, customers.refresh)
+                last_refresh = time.monotonic()
+            await calendar_crawler.crawl_sharded(url, calendar_requests(calendar_crawler, arguments))
+        except Exception:
+            pass
+
+        # poll more often when slots used to show up
+        await loop.run_in_executor(None, supervisor.wait, schedule.interval() if schedule else 5)
+
+
+async def run_async_pipeline(crawlers, calendar_crawler: AsyncCrawler, arguments, url=URL_CALENDAR,
+                             schedule: PollSchedule = None, fast_path: Booking.AsyncBookingFastPath = None):
+    """
+    Polls the calendar until a shutdown is requested, then closes the connections of all `crawlers`.
+    """
+    try:
+        await poll_calendar_async(calendar_crawler, arguments, url, schedule, fast_path)
+    finally:
+        for crawler in crawlers:
+            await crawler.close()
 
 
 def on_crawl_started(sender):
-    crawl_threads.append(sender)
+    # async crawls end with their event loop
+    if isinstance(sender, threading.Thread):
+        # only the running crawls are waited for on shutdown - don't keep the others for the whole run
+        crawl_threads[:] = [thread for thread in crawl_threads if thread.is_alive()]
+        crawl_threads.append(sender)
 
 
-def on_crawler_progress():
-    print('.', end='', flush=True)
+def on_crawler_progress(events):
+    print('.' * len(events), end='', flush=True)
 
 
 def on_crawler_stressed(sender: Crawler, url: str):
     print('8', end='\n', flush=True)
-    with sender.lock:
-        if pm:
-            pm.renew_connection()
+    if pm:
+        # only this crawler switches its circuit
+        pm.renew_connection(sender)
     if sender.name == 'Details Crawler':
-        sender.crawl(url).join()
+        # the shared rate limiter already delays the retry - don't block the notifying thread
+        if isinstance(sender, AsyncCrawler):
+            sender.crawl_soon(url)
+        else:
+            sender.crawl(url)
 
 
 def on_crawler_timeout(sender: Crawler, url: str):
     print('T', end='', flush=True)
-    with sender.lock:
-        if pm:
-            pm.renew_connection()
-
-
-def on_crawler_terminated(*args):
-    global crawler_count, cr
-    crawler_count -= 1
-    if crawler_count <= 0:
-        cr = False
-
-
-def on_crawler_match(sender: Crawler, match, source_url):
-    logging.debug('[{}]: {}'.format(sender.name, match))
-    if sender.name == 'Calendar crawler':
-        pass
-    elif sender.name == 'Details crawler':
-        pass
-    elif sender.name == 'Form Filter':
-        db_connection = sqlite3.connect(USER_DB)
-        db_connection.row_factory = sqlite3.Row
-        db_cursor = db_connection.cursor()
-        res = db_cursor.execute(
-            #"SELECT id, name, phone, mail FROM `customers` where `appointment` = '' ORDER BY `updated` LIMIT 1"
-            "SELECT c.id, c.name, c.phone, c.mail, a.id AS appointment_id, a.service_id FROM `users_customers` AS c " +
-            "CROSS JOIN `buergeramt_appointment` AS `a` on c.appointment_id=a.id " +
-            "WHERE `a`.`cancel_token` IS NULL LIMIT 1"
-        )
-        row = res.fetchone()
-        if row:
-            form = match
-            form.inputs['Nachname'].value = row['name']
-            form.inputs['EMail'].value = row['mail']
-            if 'telefonnummer_fuer_rueckfragen' in form.inputs.keys():
-                form.inputs['telefonnummer_fuer_rueckfragen'].value = row['phone']
-            if 'telefon' in form.inputs.keys():
-                form.inputs['telefon'].value = row['phone']
-            form.inputs['agbgelesen'].checked = True
-            submit_result = lhtml.submit_form(form)
-            confirmation_page_tree = lhtml.parse(submit_result).getroot()
-            cancel_tokens = confirmation_page_tree.cssselect('.number-red-big')
-            if len(cancel_tokens) > 0:
-                try:
-                    result_file = 'confirm_' + str(row['appointment_id']) + '.html'
-                    # save result for analysis
-                    with open(result_file, 'wb') as rf:
-                        rf.write(etree.tostring(confirmation_page_tree))
-                    # parse date and time
-                    date = list(map(int, '10.12.2015'.split('.')))
-                    cancel_token = cancel_tokens[0].text
-                    ""
-                    db_cursor.execute(
-                        "UPDATE `buergeramt_appointment` SET cancel_token=? WHERE id=?",
-                        (
-                            cancel_token,
-                            #datetime.datetime.isoformat(datetime.datetime(date, 12, 19, 8, 36, 0)),
-                            row['appointment_id']
-                        )
-                    )
-                    db_cursor.execute(
-                        "UPDATE `users_customers` SET confirmation_blob=? WHERE users_customers.id=?",
-                        (
-                            etree.tostring(confirmation_page_tree.find('//*[@id="hhibody"]/div[3]')),
-                            row['id']
-                        )
-                    )
-                    logging.debug('got appointment for {}'.format(row[1]))
-                except AttributeError:
-                    pass
-
-        db_cursor.close()
-        db_connection.close()
-        pass
+    if sender.name == 'Details Crawler':
+        # the day never got checked - allow the next poll to queue it again
+        day_frontier.forget(url)
+        if 'Calendar crawler' in crawlers:
+            crawlers['Calendar crawler'].forget(url)
+    if pm:
+        pm.renew_connection(sender)
+
+
+def on_slots_found(events):
+    # the details crawler's matches are the links of free slots
+    slots = [
+        slot_key(event.payload['match'], (event.payload.get('attributes') or {}).get('text'))
+        + (event.payload['match'], event.time)
+        for event in events
+        if event.sender.name == 'Details Crawler'
+    ]
+    slots = [slot for slot in slots if slot[2] is not None]
+    if slots and slot_history:
+        slot_history.seen(slots)
+
+
+def on_slot_booked(url):
+    if slot_history:
+        slot_history.booked(url)
 
 
 def reserve_appointment(appointment_link):
@@ -254,40 +610,57 @@ def reserve_appointment(appointment_link):
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Find free appointments on buergeramt website.')
-    parser.add_argument('--start_date', '-d', help='define the start date')
+    parser.add_argument('--start_date', '-d', help='first day to look for appointments (YYYY-MM-DD)', type=get_date)
+    parser.add_argument('--end_date', '-e', help='last day to look for appointments (YYYY-MM-DD)', type=get_date)
     parser.add_argument('--log-level', '-l', help='What should be logged',
                         choices=['DEBUG', 'INFO', 'WARN', 'ERROR'], default='INFO')
     parser.add_argument('--tor', '-t', help='If you want to use tor', action='store_true')
+    parser.add_argument('--shard-size', help='query the calendar for this many locations per request',
+                        type=int, default=0)
+    parser.add_argument('--shard-index', help='only crawl every n-th shard starting with this one',
+                        type=int, default=0)
+    parser.add_argument('--shard-count', help='number of calendar processes sharing the shards', type=int, default=1)
+    parser.add_argument('--stage', help='which part of the pipeline to run in this process',
+                        choices=[STAGE_ALL, STAGE_CALENDAR, STAGE_DETAILS, STAGE_FORM], default=STAGE_ALL)
+    parser.add_argument('--broker', help='sqlite file the stages exchange their jobs through',
+                        default=os.getcwd() + '/buergeramt_jobs.db')
+    parser.add_argument('--no-fast-path', help='book through the queued form crawler instead', action='store_true')
+    parser.add_argument('--async', help='run the whole pipeline on one asyncio event loop', dest='use_async',
+                        action='store_true')
+    parser.add_argument('--queue', help='work queue of a stage: STAGE=SIZE[:POLICY], SIZE 0 for no limit, '
+                                          'POLICY one of ' + ', '.join(WorkQueue.POLICIES),
+                        type=queue_setting, action='append')
+    parser.add_argument('--min-poll-interval', help='seconds between calendar polls when slots use to show up',
+                        type=float, default=2)
+    parser.add_argument('--max-poll-interval', help='seconds between calendar polls when slots never show up',
+                        type=float, default=60)
+    parser.add_argument('--budget', help='seconds a worker of a stage may spend on one match: STAGE=SECONDS',
+                        type=budget_setting, action='append')
+    parser.add_argument('--drain-timeout', help='seconds to finish the queued work on shutdown',
+                        type=float, default=10)
+    parser.add_argument('--metrics-port', help='expose metrics on http://127.0.0.1:<port>/metrics', type=int)
+    parser.add_argument('--tor-ports', help='comma separated SOCKS ports of the tor instance(s)', default='9050')
     # parser.add_argument('--socks', '-s', help='Use a socks5 proxy')
     arguments = parser.parse_args(args)
+    if arguments.use_async and (arguments.tor or arguments.stage != STAGE_ALL or arguments.no_fast_path):
+        parser.error('--async runs all stages with the fast path and without tor')
     return arguments
 
 
-cr = False
-crawler_count = 0
-
-
-def wait_exit(signal):
-    while cr:
-        pass
-    exit(signal)
-
-
 def set_exit_handler(func):
     import signal
     signal.signal(signal.SIGTERM, func)
+    signal.signal(signal.SIGINT, func)
 
 
 if __name__ == "__main__":
-    try:
+    def _exit(sig, frame=None):
+        print(" caught. shutting down")
+        supervisor.request_shutdown()
         # clean up pid file
-        def _exit(sig, func=None):
+        try:
             os.remove(os.getcwd()+'/buergeramt_crawler.pid')
-        set_exit_handler(_exit)
-        main(sys.argv[1:])
-    except KeyboardInterrupt:
-        run = False
-        print(" caught. all abort")
-        dispatcher.send(Crawler.SIGNAL_IN_TERMINATE)
-        wait_exit(0)
-
+        except OSError:
+            pass
+    set_exit_handler(_exit)
+    main(sys.argv[1:])
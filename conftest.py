@@ -0,0 +1,32 @@
+import sqlite3
+import pytest
+from DatabaseManager import DatabaseManager
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = str(tmp_path / 'buergeramt.db')
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+CREATE TABLE buergeramt_appointment (id integer primary key, service_id int, cancel_token text);
+CREATE TABLE users_customers (
+    id integer primary key, name text, phone text, mail text, appointment_id int, confirmation_blob blob
+);''')
+    for i in (1, 2):
+        connection.execute("INSERT INTO buergeramt_appointment VALUES(?,?,NULL)", (i, 121151))
+        connection.execute(
+            "INSERT INTO users_customers VALUES(?,?,?,?,?,NULL)",
+            (i, 'Kunde {}'.format(i), '030{:07d}'.format(i), 'kunde{}@example.org'.format(i), i)
+        )
+    connection.commit()
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def databases(database_path):
+    # one per process sharing the file
+    databases = [DatabaseManager(database_path), DatabaseManager(database_path)]
+    yield databases
+    for database in databases:
+        database.close()
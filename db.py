@@ -1,3 +1,8 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
 from sqlite3 import Connection
 
 
@@ -53,5 +58,241 @@ def seed(sqlite_connection: Connection):
     db_cursor.connection.commit()
 
     db_cursor.close()
-    sqlite_connection.close()
-    pass
+
+
+class CustomerQueue(object):
+    """
+    Customers still waiting for an appointment.
+
+    Pending customers are loaded in bulk and kept in memory; `refresh` only loads appointments added since the
+    last load. `claim` hands every customer to exactly one booking attempt - across threads and processes - by
+    recording the claim in the `crawler_claims` table. A claim ends with either `commit` (booked) or `release`.
+    Claims older than `claim_timeout` seconds are considered abandoned and released on the next refresh - unless
+    they are put on `hold`.
+
+    `database` is a `DatabaseManager`: claims use the calling thread's connection, bookings are handed to its
+    batching writer.
+    """
+    SQL_PENDING = (
+        "SELECT c.id, c.name, c.phone, c.mail, a.id AS appointment_id, a.service_id FROM `users_customers` AS c "
+        "CROSS JOIN `buergeramt_appointment` AS `a` on c.appointment_id=a.id "
+        "WHERE `a`.`cancel_token` IS NULL AND a.id > ? "
+        "AND a.id NOT IN (SELECT appointment_id FROM `crawler_claims`) "
+        "ORDER BY a.id"
+    )
+
+    def __init__(self, database, claim_timeout=600):
+        self.database = database
+        self.claim_timeout = claim_timeout
+        self.pending = deque()
+        self.last_appointment_id = 0
+        self.lock = threading.RLock()
+        connection = self.database.connection()
+        with self.lock, connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS `crawler_claims` (
+    appointment_id int primary key,
+    claimed_at int
+)''')
+
+    def __len__(self):
+        return len(self.pending)
+
+    def refresh(self):
+        connection = self.database.connection()
+        with self.lock:
+            with connection:
+                released = connection.execute(
+                    "DELETE FROM `crawler_claims` WHERE claimed_at < ?",
+                    (int(time.time()) - self.claim_timeout,)
+                ).rowcount
+            if released:
+                logging.info('Released %s abandoned claims', released)
+                # released customers may be older than what we already loaded
+                self.pending.clear()
+                self.last_appointment_id = 0
+            rows = connection.execute(self.SQL_PENDING, (self.last_appointment_id,)).fetchall()
+            for row in rows:
+                self.pending.append(dict(row))
+            if rows:
+                self.last_appointment_id = rows[-1]['appointment_id']
+        return self
+
+    def claim(self):
+        """
+        Returns the next pending customer or `None` if there is nobody left.
+        """
+        connection = self.database.connection()
+        with self.lock:
+            while self.pending:
+                customer = self.pending.popleft()
+                claimed_at = int(time.time())
+                try:
+                    with connection:
+                        # only appointments nobody has booked in the meantime - in this or another process
+                        claimed = connection.execute(
+                            "INSERT INTO `crawler_claims` SELECT ?,? WHERE EXISTS ("
+                            "SELECT 1 FROM `buergeramt_appointment` WHERE id=? AND cancel_token IS NULL)",
+                            (customer['appointment_id'], claimed_at, customer['appointment_id'])
+                        ).rowcount
+                except sqlite3.IntegrityError:
+                    # somebody else got this one
+                    continue
+                if not claimed:
+                    logging.debug('Appointment %s is booked already', customer['appointment_id'])
+                    continue
+                customer['claimed_at'] = claimed_at
+                return customer
+        return None
+
+    def renew(self, customer):
+        """
+        Keeps a claim held for a long time from being released as abandoned.
+        Returns `False` if the claim got lost in the meantime.
+        """
+        claimed_at = int(time.time())
+        connection = self.database.connection()
+        with self.lock, connection:
+            renewed = connection.execute(
+                "UPDATE `crawler_claims` SET claimed_at=? WHERE appointment_id=? AND claimed_at=?",
+                (claimed_at, customer['appointment_id'], customer['claimed_at'])
+            ).rowcount
+        if renewed:
+            customer['claimed_at'] = claimed_at
+        return bool(renewed)
+
+    def commit(self, customer, cancel_token, confirmation):
+        """
+        Books the customer. The writes are batched - wait on the returned future to know they are committed.
+        """
+        return self.database.write(
+            (
+                "UPDATE `buergeramt_appointment` SET cancel_token=? WHERE id=?",
+                (cancel_token, customer['appointment_id'])
+            ),
+            (
+                "UPDATE `users_customers` SET confirmation_blob=? WHERE users_customers.id=?",
+                (confirmation, customer['id'])
+            ),
+            (
+                "DELETE FROM `crawler_claims` WHERE appointment_id=?",
+                (customer['appointment_id'],)
+            ),
+        )
+
+    def hold(self, customer):
+        """
+        Keeps the claim of a customer whose booking may or may not have gone through: `refresh` never releases it.
+        Delete it from `crawler_claims` by hand once the appointment is sorted out.
+        """
+        connection = self.database.connection()
+        with self.lock, connection:
+            connection.execute(
+                "UPDATE `crawler_claims` SET claimed_at=NULL WHERE appointment_id=?",
+                (customer['appointment_id'],)
+            )
+
+    def release(self, customer):
+        connection = self.database.connection()
+        with self.lock:
+            with connection:
+                connection.execute(
+                    "DELETE FROM `crawler_claims` WHERE appointment_id=?",
+                    (customer['appointment_id'],)
+                )
+            self.pending.appendleft(customer)
+
+
+class RequestedServices(object):
+    """
+    The services (anliegen) customers are waiting for.
+    """
+    SQL_SERVICES = (
+        "SELECT service_id from users_customers as u CROSS JOIN buergeramt_appointment as a "
+        "on u.appointment_id=a.id group by service_id"
+    )
+
+    def __init__(self, database):
+        self.database = database
+        self.services = []
+
+    def refresh(self):
+        """
+        Reloads the services and tells if they changed.
+        """
+        rows = self.database.execute(self.SQL_SERVICES).fetchall()
+        services = [row['service_id'] for row in rows]
+        changed = services != self.services
+        self.services = services
+        return changed
+
+
+class SlotHistory(object):
+    """
+    Every free slot seen: where and for what it was offered, for when, through which link, how long it stayed free
+    and whether we booked it. Writes are handed to the batching writer of the `DatabaseManager`.
+    """
+    def __init__(self, database):
+        self.database = database
+        connection = self.database.connection()
+        with connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS `crawler_slots` (
+    location text,
+    service text,
+    slot_time int,
+    link text,
+    first_seen real,
+    last_seen real,
+    booked int default 0,
+    primary key (location, service, slot_time)
+)''')
+            connection.execute('CREATE INDEX IF NOT EXISTS `crawler_slots_first_seen` ON `crawler_slots` (first_seen)')
+            connection.execute('CREATE INDEX IF NOT EXISTS `crawler_slots_link` ON `crawler_slots` (link)')
+
+    def seen(self, slots):
+        """
+        Records `(location, service, slot_time, link, seen_at)` observations.
+        """
+        return self.database.write(*(
+            (
+                "INSERT INTO `crawler_slots` (location, service, slot_time, link, first_seen, last_seen) "
+                "VALUES(?,?,?,?,?,?) ON CONFLICT (location, service, slot_time) "
+                "DO UPDATE SET link=excluded.link, last_seen=excluded.last_seen",
+                (location, service, slot_time, link, seen_at, seen_at)
+            )
+            for location, service, slot_time, link, seen_at in slots
+        ))
+
+    def booked(self, link):
+        """
+        Marks the slot last seen behind `link` as booked.
+        """
+        return self.database.write((
+            "UPDATE `crawler_slots` SET booked=1 WHERE rowid=("
+            "SELECT rowid FROM `crawler_slots` WHERE link=? ORDER BY last_seen DESC LIMIT 1)",
+            (link,)
+        ))
+
+    def oldest(self, since):
+        """
+        When the first slot since the given unix timestamp was seen - `None` if there was none.
+        """
+        row = self.database.execute(
+            "SELECT min(first_seen) AS first_seen FROM `crawler_slots` WHERE first_seen >= ?", (since,)
+        ).fetchone()
+        return row['first_seen'] if row else None
+
+    def hour_of_week_counts(self, since):
+        """
+        Number of slots that showed up first in each hour of the week (local time, 0 is Sunday 0:00) since the
+        given unix timestamp.
+        """
+        counts = [0] * 7 * 24
+        rows = self.database.execute(
+            "SELECT CAST(strftime('%w', first_seen, 'unixepoch', 'localtime') AS int) * 24 "
+            "+ CAST(strftime('%H', first_seen, 'unixepoch', 'localtime') AS int) AS hour, count(*) AS slots "
+            "FROM `crawler_slots` WHERE first_seen >= ? GROUP BY hour",
+            (since,)
+        ).fetchall()
+        for row in rows:
+            counts[row['hour']] = row['slots']
+        return counts
@@ -1,5 +1,8 @@
+import copy
 import logging
 import json
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 
 
 def enable_filter():
@@ -8,8 +11,70 @@ def enable_filter():
         logging.getLogger(logger).addFilter(JsonFilter)
 
 
+def enable_queue_logging(filename, level=logging.DEBUG) -> QueueListener:
+    """
+    Logs json lines to `filename` without blocking the logging threads.
+
+    Records are only put on a queue; formatting and writing happen on the thread of the returned listener.
+    Call `stop()` on the listener at exit to flush the queue.
+    """
+    queue = Queue()
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(queue, file_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(queue))
+    listener.start()
+    return listener
+
+
 class JsonFilter(object):
+    """
+    Encodes the message of every record as json string - to be used with a json shaped format string.
+    Prefer `JsonFormatter`: the filter only applies to loggers existing when it is enabled.
+    """
     @staticmethod
     def filter(record: logging.LogRecord):
         record.msg = json.dumps(record.msg)
         return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats every record as one json object. The message is only built (with its arguments) when emitted.
+    """
+    def __init__(self, datefmt='%Y-%m-%d %H:%M:%S'):
+        super().__init__(datefmt=datefmt)
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'source': record.module,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler leaving the formatting to the listener.
+
+    The stock `QueueHandler` formats the whole record on the logging thread. This one only resolves the message
+    arguments - they might change once the caller continues - and leaves everything else to the listener's
+    handlers.
+    """
+    def prepare(self, record: logging.LogRecord):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
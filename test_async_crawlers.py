@@ -0,0 +1,26 @@
+import asyncio
+import aiohttp
+from AsyncCrawlers import AsyncRequestHedger
+
+
+def test_the_slower_request_is_cancelled():
+    async def race():
+        hedger = AsyncRequestHedger(min_delay=0.01, min_samples=1)
+        hedger._record(0.01)
+        started = []
+
+        async def fetch(session):
+            started.append(session)
+            if len(started) == 1:
+                await asyncio.sleep(10)
+            return 'hedged'
+
+        async with aiohttp.ClientSession() as session:
+            result = await hedger.get(session, fetch, 'Crawler')
+            # let the cancellation go through
+            await asyncio.sleep(0)
+            await hedger.close()
+            # leaving the loop would cancel the loser anyway
+            return result, len(hedger.background)
+
+    assert asyncio.run(race()) == ('hedged', 0)
@@ -0,0 +1,19 @@
+from Booking import BookingFastPath
+from db import CustomerQueue
+
+
+def test_customers_claimed_in_advance_are_renewed(databases):
+    customers = CustomerQueue(databases[0]).refresh()
+    fast_path = BookingFastPath(None, customers, prefetch=1)
+    fast_path.prefetch_customers()
+    # as if claimed long ago
+    customer = fast_path.claimed[0]
+    databases[0].connection().execute("UPDATE `crawler_claims` SET claimed_at=0")
+    databases[0].connection().commit()
+    customer['claimed_at'] = 0
+    fast_path.renew_claims()
+    assert list(fast_path.claimed) == [customer]
+    # still claimed for another process releasing abandoned claims
+    other = CustomerQueue(databases[1], claim_timeout=60).refresh()
+    assert other.claim()['appointment_id'] == 2
+    assert other.claim() is None
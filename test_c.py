@@ -0,0 +1,37 @@
+import time
+import pytest
+import c
+
+
+def day(date_string):
+    return int(time.mktime(time.strptime(date_string, '%Y-%m-%d')))
+
+
+def test_get_date_reads_both_formats():
+    assert c.get_date('2016-01-31') == c.get_date('31.01.2016') == day('2016-01-31')
+    with pytest.raises(ValueError):
+        c.get_date('01/31/2016')
+
+
+def test_date_window_ends_after_the_end_date():
+    arguments = c.parse_args(['--start_date', '2016-01-10', '--end_date', '2016-01-12'])
+    assert c.date_window(arguments) == (day('2016-01-10'), day('2016-01-13'))
+
+
+def test_date_window_is_at_least_a_day():
+    arguments = c.parse_args(['--start_date', '2016-01-10', '--end_date', '2016-01-01'])
+    assert c.date_window(arguments) == (day('2016-01-10'), day('2016-01-11'))
+
+
+def test_date_window_defaults_to_the_next_days():
+    start, end = c.date_window(c.parse_args([]))
+    assert start == c.start_of_day(int(time.time()))
+    assert end - start == c.DEFAULT_WINDOW_DAYS * c.DAY
+
+
+def test_calendar_pages_cover_every_month():
+    start = day('2016-01-10')
+    # one page shows two months
+    assert c.calendar_pages(start, day('2016-03-01')) == [start]
+    assert c.calendar_pages(start, day('2016-03-02')) == [start, day('2016-03-01')]
+    assert c.calendar_pages(start, day('2016-06-15')) == [start, day('2016-03-01'), day('2016-05-01')]
@@ -0,0 +1,111 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from Crawlers import Crawler, UrlFrontier, WorkQueue
+
+PAGE = b'<html><body><a href="/a">a</a><a href="/b">b</a><a href="/c">c</a></body></html>'
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def page_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_a_full_queue_blocks_the_next_crawl(page_url):
+    go_on = threading.Event()
+    crawler = Crawler(
+        worker_callback=lambda _: go_on.wait(5), work_queue=WorkQueue(maxsize=1), max_pending=1
+    ).set_selector('a').extract_links()
+    first = crawler.crawl(page_url)
+    # the first crawl can't queue all its links - it keeps its turn
+    second = threading.Thread(target=crawler.crawl, args=[page_url], daemon=True)
+    second.start()
+    second.join(0.5)
+    assert second.is_alive()
+    go_on.set()
+    second.join(5)
+    assert not second.is_alive()
+    assert first.join(5)
+    crawler.stop_workers(5)
+
+
+def test_an_url_is_admitted_once_within_the_ttl():
+    frontier = UrlFrontier(ttl=60)
+    assert frontier.admit('http://example.org/termin/day/1/')
+    assert not frontier.admit('http://example.org/termin/day/1/')
+    assert frontier.admit('http://example.org/termin/day/2/')
+
+
+def test_urls_are_compared_normalized():
+    frontier = UrlFrontier()
+    assert frontier.admit('HTTP://Example.org:80/termin?b=2&a=1#top')
+    assert not frontier.admit('http://example.org/termin?a=1&b=2')
+    assert frontier.admit('http://example.org:8080/termin?a=1&b=2')
+
+
+def test_an_url_is_admitted_again_after_the_ttl():
+    frontier = UrlFrontier(ttl=0)
+    assert frontier.admit('http://example.org/')
+    assert frontier.admit('http://example.org/')
+
+
+def test_a_forgotten_url_is_admitted_again():
+    frontier = UrlFrontier()
+    frontier.admit('http://example.org/')
+    frontier.forget('http://EXAMPLE.org/')
+    assert frontier.admit('http://example.org/')
+
+
+def test_the_least_recently_seen_urls_are_evicted():
+    frontier = UrlFrontier(max_size=2)
+    for path in ('a', 'b', 'c'):
+        frontier.admit('http://example.org/' + path)
+    assert len(frontier) == 2
+    assert frontier.admit('http://example.org/a')
+    assert not frontier.admit('http://example.org/c')
+
+
+def test_a_replaced_worker_is_accounted_for_once(page_url):
+    go_on = threading.Event()
+    handled = []
+
+    def handle(match):
+        handled.append(match)
+        # only the first match hangs
+        if len(handled) == 1:
+            go_on.wait(5)
+
+    crawler = Crawler(worker_callback=handle).set_selector('a').extract_links().set_rate_limiter(None)
+    job = crawler.crawl(page_url)
+    while not crawler.stuck_workers(0.1):
+        time.sleep(0.01)
+    stuck = crawler.stuck_workers(0.1)[0]
+    assert crawler.replace_worker(stuck)
+    assert not crawler.replace_worker(stuck)
+    # the new worker does the rest, the stuck match counts as done
+    assert job.join(5)
+    assert crawler.abandoned_workers() == 1
+    go_on.set()
+    stuck.join(5)
+    assert crawler.abandoned_workers() == 0
+    assert crawler.queue.unfinished_tasks == 0
+    assert job._pending == 0
+    assert len(handled) == 3
+    crawler.stop_workers(5)
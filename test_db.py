@@ -0,0 +1,42 @@
+from db import CustomerQueue
+
+
+def test_a_customer_is_claimed_once(databases):
+    first, second = (CustomerQueue(database).refresh() for database in databases)
+    assert first.claim()['appointment_id'] == 1
+    assert second.claim()['appointment_id'] == 2
+    assert first.claim() is None
+    assert second.claim() is None
+
+
+def test_a_booked_customer_is_not_claimed_again(databases):
+    first, second = (CustomerQueue(database).refresh() for database in databases)
+    customer = first.claim()
+    first.commit(customer, 'token', b'').result()
+    # the second queue still has the customer from before the booking
+    assert second.claim()['appointment_id'] == 2
+    assert second.claim() is None
+
+
+def test_a_released_customer_is_claimed_next(databases):
+    customers = CustomerQueue(databases[0]).refresh()
+    customer = customers.claim()
+    customers.release(customer)
+    assert customers.claim()['appointment_id'] == customer['appointment_id']
+
+
+def test_abandoned_claims_are_released_on_refresh(databases):
+    first = CustomerQueue(databases[0]).refresh()
+    second = CustomerQueue(databases[1], claim_timeout=-1).refresh()
+    first.claim()
+    first.claim()
+    assert second.claim() is None
+    assert second.refresh().claim()['appointment_id'] == 1
+
+
+def test_a_held_claim_is_never_released(databases):
+    first = CustomerQueue(databases[0]).refresh()
+    first.hold(first.claim())
+    second = CustomerQueue(databases[1], claim_timeout=-1).refresh()
+    assert second.claim()['appointment_id'] == 2
+    assert second.claim() is None
@@ -0,0 +1,65 @@
+import sqlite3
+import time
+import pytest
+from requests.exceptions import ReadTimeout
+from Crawlers import CrawlJob
+from JobBroker import SqliteJobBroker, BrokerConsumer
+
+
+class FakeCrawler(object):
+    """
+    Finishes every crawl right away - with `error` if given - or never with `hang`.
+    """
+    def __init__(self, error=None, hang=False):
+        self.error = error
+        self.hang = hang
+
+    def crawl(self, url, params=None, first_seen=None):
+        job = CrawlJob(url, params, first_seen=first_seen)
+        if self.error:
+            job.fail(self.error)
+        if not self.hang:
+            job.seal()
+        return job
+
+
+@pytest.fixture
+def broker_path(tmp_path):
+    return str(tmp_path / 'jobs.db')
+
+
+def consume(broker_path, crawler, lease=60):
+    broker = SqliteJobBroker(broker_path, poll_interval=0.01)
+    broker.put('form', {'url': 'http://example.org/slot'})
+    consumer = BrokerConsumer(broker, 'form', crawler, lease=lease).start()
+    deadline = time.monotonic() + 5
+    try:
+        while time.monotonic() < deadline:
+            rows = jobs(broker_path)
+            # acked - or handed back after one attempt
+            if not rows or (rows[0][0] == 1 and rows[0][1] is None):
+                return rows
+            time.sleep(0.01)
+    finally:
+        consumer.stop()
+    pytest.fail('the job was neither acked nor handed back')
+
+
+def jobs(broker_path):
+    connection = sqlite3.connect(broker_path)
+    try:
+        return connection.execute("SELECT attempts, leased_until FROM `jobs`").fetchall()
+    finally:
+        connection.close()
+
+
+def test_a_finished_crawl_is_acked(broker_path):
+    assert consume(broker_path, FakeCrawler()) == []
+
+
+def test_a_failed_crawl_is_handed_back(broker_path):
+    assert consume(broker_path, FakeCrawler(error=ReadTimeout())) == [(1, None)]
+
+
+def test_a_crawl_outliving_the_lease_is_handed_back(broker_path):
+    assert consume(broker_path, FakeCrawler(hang=True), lease=0.05) == [(1, None)]
@@ -0,0 +1,47 @@
+import time
+import pytest
+from PollSchedule import PollSchedule
+
+# Sunday, 10:00 local time - hour 10 of the week
+SUNDAY_10 = time.mktime((2016, 1, 3, 10, 0, 0, 0, 0, -1))
+HOUR = 60 * 60
+
+
+class FakeHistory(object):
+    def __init__(self, counts, age_days=28):
+        self.counts = counts
+        self.age_days = age_days
+
+    def hour_of_week_counts(self, since):
+        return self.counts
+
+    def oldest(self, since):
+        return time.time() - self.age_days * 24 * HOUR
+
+
+def counts(slots, hour=10):
+    counts = [0] * 7 * 24
+    counts[hour] = slots
+    return counts
+
+
+def test_the_default_interval_until_there_are_enough_slots():
+    schedule = PollSchedule(FakeHistory(counts(49)), default_interval=5)
+    assert schedule.interval(SUNDAY_10) == 5
+
+
+def test_the_default_interval_until_the_history_is_old_enough():
+    schedule = PollSchedule(FakeHistory(counts(100), age_days=6), default_interval=5)
+    assert schedule.interval(SUNDAY_10) == 5
+
+
+def test_the_busiest_hour_is_polled_fastest():
+    schedule = PollSchedule(FakeHistory(counts(100)), min_interval=2, max_interval=60)
+    assert schedule.interval(SUNDAY_10) == pytest.approx(2)
+    # half of the slots of the busiest hour count for its neighbours
+    assert schedule.interval(SUNDAY_10 + HOUR) == pytest.approx(60 * (2 / 60) ** (51 / 101))
+
+
+def test_quiet_hours_are_still_polled():
+    schedule = PollSchedule(FakeHistory(counts(100)), min_interval=2, max_interval=60, min_hotness=0.2)
+    assert schedule.interval(SUNDAY_10 + 5 * HOUR) == pytest.approx(60 * (2 / 60) ** 0.2)
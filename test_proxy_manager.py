@@ -0,0 +1,87 @@
+import socket
+import socketserver
+import struct
+import threading
+import pytest
+from Crawlers import Crawler
+from ProxyManager import TorProxyPool
+
+PAGE = b'<html><body>ok</body></html>'
+
+
+class SocksStandIn(socketserver.ThreadingTCPServer):
+    """
+    Answers every request itself - all it does like Tor is accepting SOCKS5 logins and recording them.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SocksHandler)
+        self.logins = []
+
+
+class SocksHandler(socketserver.StreamRequestHandler):
+    def read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError('client went away')
+        return data
+
+    def handle(self):
+        _, methods = self.read(2)
+        self.read(methods)
+        # username/password authentication
+        self.wfile.write(b'\x05\x02')
+        _, length = self.read(2)
+        username = self.read(length).decode()
+        password = self.read(self.read(1)[0]).decode()
+        self.server.logins.append((username, password))
+        self.wfile.write(b'\x01\x00')
+        _, _, _, address_type = self.read(4)
+        if address_type == 3:
+            self.read(self.read(1)[0])
+        else:
+            self.read(4 if address_type == 1 else 16)
+        self.read(2)
+        self.wfile.write(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 80))
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        self.wfile.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n'
+            + 'Content-Length: {}\r\n\r\n'.format(len(PAGE)).encode() + PAGE
+        )
+
+
+@pytest.fixture
+def socks_server():
+    server = SocksStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def login_of(server, crawler):
+    crawler.fetch_document('http://buergeramt.example/')
+    return server.logins[-1]
+
+
+def test_every_crawler_gets_a_circuit_of_its_own(socks_server):
+    pool = TorProxyPool(socks_ports=[socks_server.server_address[1]])
+    calendar, details = (
+        pool.assign(Crawler(name=name, worker_count=0).set_rate_limiter(None)) for name in ('Calendar', 'Details')
+    )
+    assert login_of(socks_server, calendar) == login_of(socks_server, calendar)
+    assert login_of(socks_server, calendar) != login_of(socks_server, details)
+
+
+def test_renewing_switches_only_the_circuit_of_that_crawler(socks_server):
+    pool = TorProxyPool(socks_ports=[socks_server.server_address[1]])
+    calendar, details = (
+        pool.assign(Crawler(name=name, worker_count=0).set_rate_limiter(None)) for name in ('Calendar', 'Details')
+    )
+    calendar_login, details_login = login_of(socks_server, calendar), login_of(socks_server, details)
+    pool.renew_connection(calendar)
+    assert login_of(socks_server, calendar) != calendar_login
+    assert login_of(socks_server, details) == details_login
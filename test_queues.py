@@ -0,0 +1,101 @@
+from queue import Full
+import pytest
+from Crawlers import CrawlItem, CrawlJob, WorkQueue, PriorityWorkQueue
+
+
+def queue_items(queue, job, *hrefs):
+    items = []
+    for href in hrefs:
+        item = CrawlItem('http://example.org/', href, job=job)
+        job.add_task()
+        queue.put(item, block=False)
+        items.append(item)
+    return items
+
+
+def drain(queue, job):
+    hrefs = []
+    while queue.items():
+        item = queue.get_nowait()
+        hrefs.append(item.href)
+        job.task_done()
+        queue.task_done()
+    return hrefs
+
+
+def test_block_refuses_matches_but_not_stop_signals_when_full():
+    queue = WorkQueue(maxsize=1)
+    job = CrawlJob('http://example.org/')
+    queue_items(queue, job, 'a')
+    with pytest.raises(Full):
+        queue.put(CrawlItem('http://example.org/', 'b', job=job), block=False)
+    queue.put(None, block=False)
+    assert queue.items() == 1
+    assert queue.qsize() == 2
+
+
+def test_drop_oldest_counts_the_dropped_match_as_done():
+    queue = WorkQueue(maxsize=2, policy=WorkQueue.DROP_OLDEST)
+    job = CrawlJob('http://example.org/')
+    queue_items(queue, job, 'a', 'b', 'c')
+    job.seal()
+    assert queue.items() == 2
+    assert queue.unfinished_tasks == 2
+    assert not job.done()
+    assert drain(queue, job) == ['b', 'c']
+    assert job.done()
+    assert queue.unfinished_tasks == 0
+
+
+def test_drop_oldest_keeps_stop_signals():
+    queue = WorkQueue(maxsize=1, policy=WorkQueue.DROP_OLDEST)
+    job = CrawlJob('http://example.org/')
+    queue.put(None)
+    queue_items(queue, job, 'a', 'b')
+    assert queue.items() == 1
+    assert queue.stop_signals == 1
+
+
+def test_coalesce_drops_links_queued_already():
+    queue = WorkQueue(maxsize=10, policy=WorkQueue.COALESCE)
+    job = CrawlJob('http://example.org/')
+    queue_items(queue, job, 'a', 'b', 'a')
+    job.seal()
+    assert queue.items() == 2
+    assert queue.unfinished_tasks == 2
+    assert queue.queued_links == {'a': 1, 'b': 1}
+    assert drain(queue, job) == ['a', 'b']
+    assert job.done()
+    assert queue.queued_links == {}
+    # handed out - the link may be queued again
+    queue_items(queue, job, 'a')
+    assert queue.items() == 1
+
+
+def test_coalesce_queues_stop_signals():
+    queue = WorkQueue(policy=WorkQueue.COALESCE)
+    queue.put(None)
+    queue.put(None)
+    assert queue.qsize() == 2
+    assert queue.items() == 0
+    assert queue.get_nowait() is None
+    assert queue.stop_signals == 1
+
+
+def test_priority_queue_hands_out_lowest_key_first():
+    queue = PriorityWorkQueue(key=lambda item: int(item.href) if item.href.isdigit() else None)
+    job = CrawlJob('http://example.org/')
+    queue.put(None)
+    queue_items(queue, job, '3', 'x', '1', '2')
+    handed_out = [queue.get_nowait() for _ in range(5)]
+    assert [item.href for item in handed_out[:4]] == ['1', '2', '3', 'x']
+    assert handed_out[4] is None
+
+
+def test_priority_queue_drops_the_match_queued_first():
+    queue = PriorityWorkQueue(key=lambda item: int(item.href), maxsize=2, policy=WorkQueue.DROP_OLDEST)
+    job = CrawlJob('http://example.org/')
+    queue_items(queue, job, '1', '3', '2')
+    job.seal()
+    assert drain(queue, job) == ['2', '3']
+    assert job.done()
@@ -0,0 +1,54 @@
+import time
+from email.utils import formatdate
+import pytest
+from RateLimiter import AdaptiveRateLimiter
+
+URL = 'http://service.example/termin/tag.php'
+
+
+def test_the_burst_goes_through_right_away():
+    limiter = AdaptiveRateLimiter(initial_rate=1.0, burst=2)
+    assert limiter.reserve(URL) == 0
+    assert limiter.reserve(URL) == 0
+    assert limiter.reserve(URL) == pytest.approx(1.0, abs=0.05)
+
+
+def test_hosts_are_limited_apart():
+    limiter = AdaptiveRateLimiter(initial_rate=1.0, burst=1)
+    limiter.reserve(URL)
+    assert limiter.reserve('http://other.example/') == 0
+    assert limiter.reserve('http://SERVICE.example/termin/termin.php') > 0
+
+
+def test_the_rate_grows_with_every_success_up_to_the_maximum():
+    limiter = AdaptiveRateLimiter(initial_rate=1.0, max_rate=1.2, increase=0.1)
+    limiter.on_success(URL)
+    assert limiter.rate(URL) == pytest.approx(1.1)
+    limiter.on_success(URL)
+    limiter.on_success(URL)
+    assert limiter.rate(URL) == pytest.approx(1.2)
+
+
+def test_the_rate_is_cut_once_per_congestion():
+    limiter = AdaptiveRateLimiter(initial_rate=1.0, min_rate=0.4, decrease=0.5)
+    limiter.on_timeout(URL)
+    # failing together with the first one
+    limiter.on_too_many_requests(URL)
+    assert limiter.rate(URL) == pytest.approx(0.5)
+    limiter.buckets['service.example'].last_decrease -= 10
+    limiter.on_timeout(URL)
+    assert limiter.rate(URL) == pytest.approx(0.4)
+
+
+def test_retry_after_blocks_the_host():
+    limiter = AdaptiveRateLimiter(burst=4)
+    limiter.on_too_many_requests(URL, '3')
+    assert limiter.reserve(URL) == pytest.approx(3, abs=0.05)
+    assert limiter.reserve('http://other.example/') == 0
+
+
+def test_retry_after_is_read_as_seconds_or_date():
+    assert AdaptiveRateLimiter.parse_retry_after('120') == 120
+    assert AdaptiveRateLimiter.parse_retry_after(formatdate(time.time() + 60, usegmt=True)) == pytest.approx(60, abs=2)
+    assert AdaptiveRateLimiter.parse_retry_after('soon') is None
+    assert AdaptiveRateLimiter.parse_retry_after(None) is None